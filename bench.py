@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+##########################################################################################
+### Prep stuff
+##########################################################################################
+# bench.py generates a synthetic site and times how long crunch takes to build it, stage
+# by stage, both cold (empty build folder and cache) and warm (straight after a build).
+# The results are added to a results file so that a regression shows up as a number.
+import sys
+import os
+import shutil
+import random
+import time
+import json
+import tempfile
+import subprocess
+import argparse
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.image import MIMEImage
+from email.Utils import formatdate
+
+try:
+  from PIL import Image
+  imaging_available = True
+except:
+  imaging_available = False
+
+parser = argparse.ArgumentParser(description='Benchmarks crunch on a synthetic site.')
+parser.add_argument('--crunch', dest='crunch',
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         'crunch.py'),
+                    help='The crunch.py to benchmark, defaults to the one next to \
+                    bench.py.')
+parser.add_argument('--galleries', dest='galleries', type=int, default=2,
+                    help='Number of galleries, defaults to 2.')
+parser.add_argument('--images', dest='images', type=int, default=10,
+                    help='Number of images in each gallery, defaults to 10.')
+parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                    help='Passed on to crunch as --jobs, defaults to 1.')
+parser.add_argument('--keep', dest='keep',
+                    help='Builds the site in this folder and leaves it there, rather \
+                    than in a temporary folder.')
+parser.add_argument('--pages', dest='pages', type=int, default=5,
+                    help='Number of static pages, defaults to 5.')
+parser.add_argument('--posts', dest='posts', type=int, default=10,
+                    help='Number of posts in each month, defaults to 10.')
+parser.add_argument('--results', dest='results', default='bench.json',
+                    help='File the results are added to, defaults to bench.json.')
+parser.add_argument('--runs', dest='runs', type=int, default=3,
+                    help='Number of times each stage is timed, the median is reported. \
+                    Defaults to 3.')
+parser.add_argument('--seed', dest='seed', type=int, default=1,
+                    help='Seed for the generated content, defaults to 1.')
+parser.add_argument('--stages', dest='stages',
+                    default='posts,indexes,home,feed,extras,galleries,email',
+                    help='Comma separated stages to time, defaults to all of them.')
+parser.add_argument('--years', dest='years', type=int, default=3,
+                    help='Number of years of posts, defaults to 3.')
+args = parser.parse_args()
+
+##########################################################################################
+### Define some variables
+##########################################################################################
+
+# The crunch flag for each stage and the name of the crunch_* function its time is taken
+# from in the profile.
+stages = {'posts': ('--posts', 'crunch_posts'),
+          'indexes': ('--indexes', 'crunch_indexes'),
+          'home': ('--home', 'crunch_home'),
+          'feed': ('--feed', 'crunch_feed'),
+          'extras': ('--extras', 'crunch_extras'),
+          'galleries': ('--galleries', 'crunch_gallery_all'),
+          'email': ('--email', 'crunch_email')}
+
+conf = """extension: .md
+server_port: 8000
+server_redirect_htm: True
+email_sender: bench@example.com
+email_receiver: no-reply@example.com
+title: crunch benchmark
+tagline: writing on the web, so you don't have to.
+author: bench.py
+description: A synthetic site for benchmarking crunch.
+base_url: http://bench.example.com/
+build_folder: built
+posts_folder: posts
+pages_folder: pages
+public_folder: public
+images_folder: images
+galleries_folder: galleries
+css_folder: css
+scripts_folder: scripts
+home_count: 10
+feed_count: 20
+image_width: 640
+image_height: 640
+"""
+
+words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+         'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+         'exercitation ullamco laboris nisi aliquip ex ea commodo consequat').split()
+
+##########################################################################################
+### Helper Functions
+##########################################################################################
+
+# sentence() returns a random sentence of about count words.
+def sentence(count):
+  return ' '.join(random.choice(words) for i in range(count)).capitalize() + '.'
+
+# markdown() returns a random post body with paragraphs, a list, links and a code block.
+def markdown():
+  parts = []
+  for i in range(random.randint(2, 6)):
+    parts.append(' '.join(sentence(random.randint(6, 16)) for j in range(4)))
+  parts.append('\n'.join('* ' + sentence(5) for i in range(4)))
+  parts.append('See [' + random.choice(words) + '](http://example.com/' +
+               random.choice(words) + ') for *more*.')
+  parts.append('    :::python\n' + '\n'.join('    def %s(x):\n        return x * %d\n' %
+               (random.choice(words), i) for i in range(random.randint(1, 5))))
+  random.shuffle(parts)
+  return '\n\n'.join(parts) + '\n'
+
+# jpeg() saves a random image of the given size as a JPEG.
+def jpeg(path, size):
+  image = Image.new('RGB', size, tuple(random.randint(0, 255) for i in range(3)))
+  noise = Image.effect_noise(size, 40).convert('RGB')
+  Image.blend(image, noise, 0.5).save(path, 'JPEG', quality=90)
+
+# generate_site() writes a synthetic site into folder along with a copy of crunch.
+def generate_site(folder):
+  random.seed(args.seed)
+
+  for name in ['posts', 'pages', 'public/error', 'images/posts', 'galleries', 'css',
+               'scripts']:
+    os.makedirs(os.path.join(folder, name))
+  shutil.copy(args.crunch, os.path.join(folder, 'crunch.py'))
+  open(os.path.join(folder, 'conf.yaml'), 'w').write(conf)
+  open(os.path.join(folder, 'public/robots.txt'), 'w').write('User-agent: *\n')
+
+  # Posts, args.posts a month for args.years years.
+  count = 0
+  for year in range(2000, 2000 + args.years):
+    for month in range(1, 13):
+      month_folder = os.path.join(folder, 'posts', '%04d' % year, '%02d' % month)
+      os.makedirs(month_folder)
+      for day in range(args.posts):
+        count += 1
+        date = time.mktime((year, month, 1 + day * 27 / args.posts,
+                            random.randint(0, 23), random.randint(0, 59), 0, 0, 0, -1))
+        f = open(os.path.join(month_folder, 'post-%d.md' % count), 'w')
+        f.write('title: Post %d %s\ndate: %d\nshort: b%d\n\n' %
+                (count, sentence(4)[:-1], date, count) + markdown())
+        f.close()
+
+  # Static pages.
+  for page in range(args.pages):
+    open(os.path.join(folder, 'pages', 'page-%d.md' % page), 'w').write(
+      'title: Page %d\n\n' % page + markdown())
+
+  # Stylesheets and scripts.
+  for i in range(4):
+    open(os.path.join(folder, 'css', 'style-%d.css' % i), 'w').write(''.join(
+      '/* %s */\n.%s-%d {\n  color: #%06x; /* %s */\n  margin: %dpx;\n}\n' %
+      (sentence(6), random.choice(words), j, random.randint(0, 0xffffff),
+       random.choice(words), j) for j in range(200)))
+    open(os.path.join(folder, 'scripts', 'script-%d.js' % i), 'w').write(''.join(
+      '// %s\nfunction %s_%d(x) {\n  var s = "%s // not a comment";\n  '
+      'return x / %d; // %s\n}\n' % (sentence(6), random.choice(words), j,
+      random.choice(words), j + 1, random.choice(words)) for j in range(200)))
+
+  # Galleries of real JPEGs.
+  if imaging_available:
+    for gallery in range(args.galleries):
+      gallery_folder = os.path.join(folder, 'galleries', 'gallery-%d' % gallery)
+      os.makedirs(gallery_folder)
+      open(os.path.join(gallery_folder, 'meta.yaml'), 'w').write(
+        'title: Gallery %d\ndate: %d\n\n%s\n' % (gallery, 946684800 + gallery * 86400,
+                                                 sentence(12)))
+      for image in range(args.images):
+        jpeg(os.path.join(gallery_folder, 'image-%d.jpg' % image), (1600, 1200))
+  else:
+    print 'WARN: PIL unavailable, the galleries will be empty.'
+
+  return count
+
+# make_email() returns a post by email, with a JPEG attached if PIL is available.
+def make_email(folder):
+  message = MIMEMultipart()
+  message['From'] = 'bench@example.com'
+  message['To'] = 'no-reply@example.com'
+  message['Subject'] = 'Emailed post ' + sentence(3)[:-1]
+  message['Date'] = formatdate(time.mktime((2000 + args.years - 1, 12, 28, 12, 0, 0, 0,
+                                            0, -1)), localtime=True)
+  message.attach(MIMEText(markdown()))
+  if imaging_available:
+    path = os.path.join(folder, 'attachment.jpg')
+    jpeg(path, (2048, 1536))
+    message.attach(MIMEImage(open(path, 'rb').read(), 'jpeg'))
+    os.remove(path)
+  return message.as_string()
+
+# files() returns every file under folder.
+def files(folder):
+  return set(os.path.join(root, name) for root, dirs, names in os.walk(folder)
+             for name in names)
+
+# run_crunch() runs crunch in folder with the given flags and returns the wall time of
+# the whole run and of the named stage, as recorded by --profile.
+def run_crunch(folder, flags, stage, stdin=None):
+  start = time.time()
+  process = subprocess.Popen([sys.executable, '-W', 'ignore', 'crunch.py', '--no-http',
+                              '--jobs', str(args.jobs), '--profile', 'profile.json'] +
+                             flags, cwd=folder, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = process.communicate(stdin)
+  wall = time.time() - start
+
+  if process.returncode:
+    sys.stderr.write(err)
+    print 'ERROR: crunch ' + ' '.join(flags) + ' failed.'
+    sys.exit(1)
+
+  report = json.load(open(os.path.join(folder, 'profile.json')))
+  return wall, sum(entry['wall'] for entry in report['stages'] if entry['stage'] == stage)
+
+# clear() empties the build folder and cache so that the next run is cold.
+def clear(folder):
+  for name in 'built', 'cache':
+    if os.path.exists(os.path.join(folder, name)):
+      shutil.rmtree(os.path.join(folder, name))
+
+# median() returns the middle of a list of numbers.
+def median(values):
+  values = sorted(values)
+  middle = len(values) / 2
+  if len(values) % 2: return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+# time_stage() times a stage cold and warm args.runs times each and returns the medians.
+def time_stage(folder, name):
+  flag, stage = stages[name]
+  samples = {'cold': [], 'warm': []}
+
+  for run in range(args.runs):
+    for state in 'cold', 'warm':
+      if state == 'cold': clear(folder)
+
+      # Posts by email add files to the site, take them back out after each run.
+      if name == 'email':
+        before = files(os.path.join(folder, 'posts')) | \
+                 files(os.path.join(folder, 'images'))
+        result = run_crunch(folder, [flag], stage, make_email(folder))
+        for path in (files(os.path.join(folder, 'posts')) |
+                     files(os.path.join(folder, 'images'))) - before:
+          os.remove(path)
+      else:
+        result = run_crunch(folder, [flag], stage)
+
+      samples[state].append(result)
+
+  return dict((state, {'wall': round(median([wall for wall, stage in samples[state]]), 4),
+                       'stage': round(median([stage for wall, stage in samples[state]]),
+                                      4)})
+              for state in samples)
+
+##########################################################################################
+### Party Time.
+##########################################################################################
+def main():
+  names = [name.strip() for name in args.stages.split(',')]
+  for name in names:
+    if not name in stages:
+      print 'ERROR: Unknown stage ' + name + '.'
+      sys.exit(1)
+
+  if args.keep:
+    folder = os.path.abspath(args.keep)
+    if os.path.exists(folder): shutil.rmtree(folder)
+    os.makedirs(folder)
+  else:
+    folder = tempfile.mkdtemp(prefix='crunch-bench-')
+
+  try:
+    print 'Generating the site in ' + folder + '.'
+    count = generate_site(folder)
+    print 'Generated ' + str(count) + ' posts.'
+
+    results = {}
+    for name in names:
+      results[name] = time_stage(folder, name)
+      print '%-10s cold %8.3fs (stage %8.3fs)   warm %8.3fs (stage %8.3fs)' % (name,
+        results[name]['cold']['wall'], results[name]['cold']['stage'],
+        results[name]['warm']['wall'], results[name]['warm']['stage'])
+  finally:
+    if not args.keep: shutil.rmtree(folder)
+
+  settings = {'years': args.years, 'posts': args.posts, 'pages': args.pages,
+              'galleries': args.galleries, 'images': args.images, 'jobs': args.jobs,
+              'seed': args.seed, 'runs': args.runs}
+
+  # Compare with the last results for the same settings.
+  history = []
+  if os.path.exists(args.results):
+    history = json.load(open(args.results))
+  previous = [record for record in history if record['settings'] == settings]
+  if previous:
+    print 'Compared to ' + previous[-1]['date'] + ':'
+    for name in names:
+      if not name in previous[-1]['results']: continue
+      for state in 'cold', 'warm':
+        before = previous[-1]['results'][name][state]['wall']
+        after = results[name][state]['wall']
+        if before:
+          print '%-10s %s %+7.1f%%' % (name, state, (after - before) / before * 100)
+
+  history.append({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'settings': settings,
+                  'python': sys.version.split()[0], 'results': results})
+  f = open(args.results, 'w')
+  json.dump(history, f, indent=2, sort_keys=True)
+  f.close()
+  print 'Added the results to ' + args.results + '.'
+
+if __name__ == "__main__":
+  main()
@@ -10,11 +10,30 @@ import shutil
 import re
 import time
 import uuid
-import urllib2
+import hashlib
+import json
+import mailbox
+import sqlite3
+import inspect
+import httplib
+import urlparse
+import socket
+import threading
+import traceback
+import itertools
+import tempfile
+import binascii
+import quopri
+import gzip
+import multiprocessing
+import resource
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 import email
+import email.parser
 import smtplib
 from email.mime.text import MIMEText
-from email.Utils import formatdate
+from email.Utils import formatdate, parsedate_tz, mktime_tz
 
 try:
   import argparse
@@ -34,10 +53,14 @@ try:
 except: 
   markdown_available = False
 
+try:
+  import pyinotify
+  inotify_available = True
+except:
+  inotify_available = False
+
 try:
   from PIL import Image
-  from StringIO import StringIO
-  from PIL import ExifTags
   imaging_available = True
 except:
   imaging_available = False
@@ -50,27 +73,53 @@ if argparse_available:
                       help='Builds the entire site.')
   parser.add_argument('--clean', dest='clean', action='store_true',
                       help='Empties the build folder.')
+  parser.add_argument('--clear-cache', dest='clear_cache', action='store_true',
+                      help='Empties the markdown render cache before building.')
   parser.add_argument('--dependencies', dest='dependencies', action='store_true',
                       help='Builds all the dependencies, ignored unless used with \
                       --single, --new, or --email.')
+  parser.add_argument('--deterministic', dest='deterministic', action='store_true',
+                      help='Leaves the build time out of generated pages so that two \
+                      builds from the same sources are identical. Uses \
+                      SOURCE_DATE_EPOCH instead if it is set.')
   parser.add_argument('--email', dest='email', action='store_true',
                       help='Reads an email message from STDIN and parses to create a new \
                       post. Overrides --all, --posts, --indexes, --home, and --single')
   parser.add_argument('--error', dest='error', action='store_true', 
                       help='Generates static error pages.')
   parser.add_argument('--extras', dest='extras', action='store_true',
-                      help='Generates minified css and js files.')
+                      help='Generates minified css and js bundles, named after a hash \
+                      of their content.')
   parser.add_argument('--feed', dest='feed', action='store_true',
                       help='Generates RSS feed.')
   parser.add_argument('--galleries', dest='galleries', action='store_true',
                       help='Generates galleries.')
+  parser.add_argument('--gzip', dest='gzip', action='store_true',
+                      help='Writes a maximally compressed .gz copy next to every text \
+                      file in the build folder that changed, for servers that can \
+                      send them as is.')
   parser.add_argument('--home', dest='home', action='store_true',
                       help='Builds the home page.')
+  parser.add_argument('--import-maildir', dest='import_maildir', metavar='MAILDIR',
+                      help='Makes a post out of every message in a Maildir, like \
+                      --email, then rebuilds the pages that include them once.')
+  parser.add_argument('--import-mbox', dest='import_mbox', metavar='MBOX',
+                      help='Makes a post out of every message in an mbox file, like \
+                      --email, then rebuilds the pages that include them once.')
+  parser.add_argument('--incremental', dest='incremental', action='store_true',
+                      help='Only rebuilds the posts, indexes, home page and feed whose \
+                      sources changed since the last build.')
   parser.add_argument('--indexes', dest='indexes', action='store_true',
                       help='Builds the index pages.')
+  parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                      help='Number of processes used to build posts and gallery \
+                      images, defaults to 1.')
   parser.add_argument('--new', dest='new', action='store_true',
                       help='Starts an interactive sesson to create a new post. *Not yet \
                       implemented*')
+  parser.add_argument('--no-cache', dest='cache', action='store_false',
+                      help='Renders all markdown from scratch without reading or \
+                      writing the render cache.')
   parser.add_argument('--no-http', dest='http', action='store_false',
                       help='Prevents crunch from contacting external sources during the \
                       build.')
@@ -78,18 +127,26 @@ if argparse_available:
                       help='Builds all static pages.')
   parser.add_argument('--posts', dest='posts', action='store_true',
                       help='Builds all posts.')
+  parser.add_argument('--profile', dest='profile', nargs='?', const='profile.json',
+                      metavar='REPORT',
+                      help='Times each build stage and each post parse, render and \
+                      write, http request and gallery image, prints a summary and \
+                      writes a JSON report to REPORT, profile.json by default.')
   parser.add_argument('--serve', dest='serve', action='store_true',
                       help='Starts a lightweight HTTP server to serve build folder to \
                       localhost.')
   parser.add_argument('--setup', dest='setup', action='store_true',
                       help='Creates a basic blog framework to start with. *Not yet \
                       implemented.*')
-  parser.add_argument('--single', dest='single',
+  parser.add_argument('--single', dest='single', metavar='PATH',
                       help='Builds a single post. Takes a filename as an argument or use \
-                      - to read from STDIN. Overrides --all, --posts, --indexes, --home \
-                      *Not yet implemented.*')
+                      - to read from STDIN. Overrides --all, --posts, --indexes, --home')
   parser.add_argument('--verbose', dest='verbose', action='store_true',
                       help='Enables information display other than errors.')
+  parser.add_argument('--watch', dest='watch', action='store_true',
+                      help='Keeps running after the build and incrementally rebuilds \
+                      whatever the posts, pages, galleries, css, scripts or conf.yaml \
+                      feed into whenever they change. Can be used with --serve.')
   args = parser.parse_args()
 else:
   print 'ERROR: The python module argparse is unavailable. Please install argparse and \
@@ -100,6 +157,9 @@ else:
 ### Define some variables
 ##########################################################################################
 
+### The time this build started.
+build_time = time.localtime()
+
 ### Folder Structures are relative to where crunch is.
 base_folder = os.path.abspath(os.path.dirname(sys.argv[0]))
 
@@ -124,6 +184,7 @@ images_folder = base_folder + '/' + conf['images_folder']
 galleries_folder = base_folder + '/' + conf['galleries_folder']
 css_folder = base_folder + '/' + conf['css_folder']
 scripts_folder = base_folder + '/' + conf['scripts_folder']
+cache_folder = base_folder + '/' + conf.get('cache_folder', 'cache')
 
 
 ### Classes
@@ -151,10 +212,11 @@ class Post:
   title = 'Title'
   time = 0.0
   markdown = 'Content'
-  content = '<p>Content</p>'
   slug = 'slug'
   short = 'amd1'
   filename = slug + '.md'
+  source = None
+  index_row = None
 
   # Get a 4 digit year from the epoch time.
   def year(self):
@@ -188,39 +250,72 @@ class Post:
   def url_short(self):
     return 'http://amd.im/' + self.short
 
-  # Parses a string to populate the post object.
+  # Parses a string to populate the post object. The body isn't rendered until the post's
+  # content is used.
   def parse(self, string):
     header, body = string.split('\n\n', 1)               
-  
+    self.parse_header(header)
+    self.markdown = body
+
+  # Reads just the header of a post file to populate the post object. The rest of the file
+  # isn't read until the post's content is used.
+  def load(self, path):
+    self.source = path
+    self.markdown = None
+    self.parse_header(read_header(path))
+
+  # Parses the yaml header of a post to populate everything but the body.
+  def parse_header(self, header):
+    wall, cpu = time.time(), time.clock()
     y = yaml.load(header)
       
     self.title = y['title']
     
     self.time = time.localtime(y['date'])
     
-    self.slug = re.sub('\-{2,}', '-', re.sub('[^a-z0-9-]', '', re.sub('\s', '-', \
-                re.sub('&', 'and', str(self.title).lower()))))
+    self.slug = make_slug(self.title)
 
-    # if the short url is pre-defined, use that, otherwise get a new one from amd.im.
+    # if the short url is pre-defined, use that, otherwise look it up in the short url 
+    # store or get a new one from amd.im.
     if 'short' in y: 
       self.short = y['short']
     else:
-      if args.http:
-        self.short = urllib2.urlopen('http://amd.im/api-create/' + conf['base_url'] + \
-                                      self.year() + '/' + self.month() + '/' + \
-                                      self.slug).read().lstrip('http://amd.im/')
-      else:
-        if args.verbose: print 'WARN: HTTP disabled. Short URL unavailable.'
+      self.short = get_short(post_link(self.time, self.slug))
+      if self.short is None:
+        if args.verbose and not args.http: 
+          print 'WARN: HTTP disabled. Short URL unavailable.'
+        elif args.verbose:
+          print 'WARN: Short URL unavailable.'
         self.short = ''
-
-
+    
+    profile_step('parse', self.source and os.path.relpath(self.source, base_folder) or
+                 self.slug, wall, cpu)
+
+  # Renders the body of the post into content, reading it from the post file first if 
+  # only the header was loaded.
+  def render(self):
+    wall, cpu = time.time(), time.clock()
+    if self.markdown is None:
+      f = open(self.source)
+      self.markdown = f.read().split('\n\n', 1)[1]
+      f.close()
+    
     # if markdown is available, use that to process the post body.
-    self.markdown = body
     if markdown_available:
-      self.content = markdown2.markdown(str(body), extras=["code-color", "code-friendly"])
+      self.content = render_markdown(str(self.markdown))
     else:
       if args.verbose: print 'WARN: markdown unavailable, using raw post data.'
       self.content = self.markdown
+    
+    profile_step('render', self.source and os.path.relpath(self.source, base_folder) or
+                 self.slug, wall, cpu)
+
+  # The content is rendered the first time it's asked for.
+  def __getattr__(self, name):
+    if name == 'content':
+      self.render()
+      return self.content
+    raise AttributeError(name)
 
   # returns a string that has a fully templated post.
   def formatted(self):
@@ -230,6 +325,9 @@ class Post:
     return format_xml_item(self)
 
 
+# Define some allowable image extensions for galleries.
+image_extensions = ('.jpg', '.jpeg', '.gif', '.png')
+
 class Gallery_Image:
   master_image = 'img.jpg'
   gallery_name = 'test'
@@ -269,13 +367,105 @@ class Gallery_Image:
     return format_gallery_thumb(self)
 
 
+# Define a class for writing an output file. Content is written in pieces and hashed as it
+# goes, held in memory until it passes a megabyte and spilled to a temporary file after 
+# that. Closing compares the hash with the file on disk and only replaces it, atomically, 
+# if something changed.
+class Output_File:
+  limit = 1024 * 1024
+  
+  def __init__(self, filename):
+    self.filename = filename
+    self.hash = hashlib.sha1()
+    self.chunks = []
+    self.size = 0
+    self.tmp = None
+  
+  def write(self, data):
+    if isinstance(data, unicode): data = data.encode('utf-8')
+    self.hash.update(data)
+    if self.tmp:
+      self.tmp.write(data)
+      return
+    
+    self.chunks.append(data)
+    self.size += len(data)
+    
+    # Too big to keep around, move it all to a temporary file.
+    if self.size > self.limit:
+      self.tmp = open(self.filename + '.' + str(os.getpid()) + '.tmp', 'wb')
+      self.tmp.write(''.join(self.chunks))
+      self.chunks = []
+  
+  # Returns True if the file was written, False if it was already up to date.
+  def close(self):
+    digest = self.hash.hexdigest()
+    if file_signature(self.filename) == digest:
+      if self.tmp:
+        self.tmp.close()
+        os.remove(self.tmp.name)
+      output_counts['skipped'] += 1
+      return False
+    
+    if self.tmp:
+      self.tmp.close()
+      os.chmod(self.tmp.name, 0644)
+      os.rename(self.tmp.name, self.filename)
+    else:
+      replace_file(self.filename, ''.join(self.chunks))
+    output_counts['written'] += 1
+    
+    # Remember the new hash so the next build doesn't have to read the file back.
+    st = os.stat(self.filename)
+    get_manifest()['files'][os.path.relpath(self.filename, base_folder)] = \
+      [st.st_mtime, st.st_size, digest]
+    return True
+
+
 ##########################################################################################
 ### Templates.
 ##########################################################################################
 
 
-# General purpose formatter for a full page, takes in a Page object. 
+# build_stamp() returns the comment that marks when a page was generated. The time comes 
+# from SOURCE_DATE_EPOCH if it is set, otherwise from the start of the build. With 
+# --deterministic and no SOURCE_DATE_EPOCH there is no stamp at all, so that pages only 
+# change when their sources do.
+def build_stamp():
+  if 'SOURCE_DATE_EPOCH' in os.environ:
+    stamp = time.gmtime(int(os.environ['SOURCE_DATE_EPOCH']))
+  elif args.deterministic:
+    return ''
+  else:
+    stamp = build_time
+  return '\n  <!-- Generated by crunch on ' + time.strftime('%Y-%m-%d at %H:%M:%S', stamp) + \
+    ' -->'
+
+# General purpose formatter for a full page, takes in a Page object. The layout around
+# the title and body is the same for every page, so it's rendered once per build by 
+# layout_chunks() and each page is just the chunks joined with its title and body. It 
+# links to the current stylesheet and script bundles made by crunch_extras().
 def format_layout(page):
+  prefix, middle, suffix = layout_chunks(page.author, page.description)
+  return ''.join([prefix, page.title, middle, page.body, suffix])
+
+# The layout chunks for each author, description and pair of bundles, see layout_chunks().
+layout_cache = {}
+
+# layout_chunks() returns the layout rendered by format_chrome() split into the parts 
+# before the title, between the title and the body, and after the body.
+def layout_chunks(author, description):
+  key = (author, description, bundle_url('css'), bundle_url('js'))
+  if not key in layout_cache:
+    layout = format_chrome('\0title\0', '\0body\0', author, description, build_stamp(), 
+                           key[2], key[3])
+    prefix, rest = layout.split('\0title\0')
+    middle, suffix = rest.split('\0body\0')
+    layout_cache[key] = (prefix, middle, suffix)
+  return layout_cache[key]
+
+# The layout for a full page, used by layout_chunks().
+def format_chrome(title, body, author, description, stamp, css, js):
   return """<html>
   <head>
     <meta charset="utf-8" />
@@ -288,7 +478,7 @@ def format_layout(page):
 
     <link rel="icon" type="image/png" href="/images/favicon.png" />
 
-    <link rel="stylesheet" type="text/css" href="/css/app.css" />
+    <link rel="stylesheet" type="text/css" href="%(css)s" />
 
     <link rel="alternate" type="application/atom+xml" title="amdavidson.com feed" 
           href="/index.xml" />
@@ -343,14 +533,13 @@ def format_layout(page):
     </div>
 
     <script src="/scripts/zepto.min.js"></script>
-    <script src="/scripts/app.js"></script>
+    <script src="%(js)s"></script>
     <script src="http://mint.amdavidson.com/?js" type="text/javascript"></script>
 
-  </body>
-  <!-- Generated by crunch on %(date)s -->
+  </body>%(stamp)s
 </html>
-""" % {'title':page.title, 'body':page.body, 'author':page.author, 
-       'description':page.description, 'date':time.strftime('%Y-%m-%d at %H:%M:%S')}
+""" % {'title':title, 'body':body, 'author':author, 'description':description, 
+       'stamp':stamp, 'css':css, 'js':js}
 
 # General purpose formatter for a specific post, takes in a Post object
 def format_post(post):
@@ -421,6 +610,18 @@ def format_xml_item(post):
   """ % {'title': post.title, 'url': conf['base_url'].rstrip('/') + post.url(), \
          'date_2822': post.date_2822(), 'body': post.content }
 
+# Formatter for the links between the pages of a paginated index. Takes in the urls of the
+# newer and older pages, either of which may be None.
+def format_pagination(newer, older):
+  links = []
+  if newer: links.append('<a href="%s" rel="prev">&larr; Newer posts</a>' % newer)
+  if older: links.append('<a href="%s" rel="next">Older posts &rarr;</a>' % older)
+  return """
+      <div class="eleven columns">
+        <p class="pagination">%(links)s</p>
+      </div>
+  """ % {'links': ' | '.join(links)}
+
 def format_gallery_single(image):
   return """
       <div class="eleven columns">
@@ -443,81 +644,960 @@ def format_gallery_thumb(image):
 ##########################################################################################
 
 
+# The extras used for every markdown render.
+markdown_extras = ["code-color", "code-friendly"]
+
+# The renderer versions are part of every render cache key. Pygments does the code 
+# coloring, so its version matters as much as markdown2's.
+try:
+  import pygments
+  renderer_version = markdown2.__version__ + '/' + pygments.__version__
+except:
+  renderer_version = markdown_available and markdown2.__version__ or ''
+
+# render_markdown() takes in a markdown string and returns the rendered html. Renders are 
+# kept in the cache folder keyed by a hash of the source, the extras and the renderer 
+# versions, so text that hasn't changed is only rendered once across runs.
+def render_markdown(text):
+  if isinstance(text, unicode): text = text.encode('utf-8')
+
+  key = hashlib.sha1('\n'.join([renderer_version, ','.join(markdown_extras), 
+                                 text])).hexdigest()
+  path = cache_folder + '/markdown/' + key[:2] + '/' + key + '.htm'
+  
+  # Use the cached copy if there is one, touching it so it counts as recently used.
+  if args.cache and os.path.exists(path):
+    os.utime(path, None)
+    return open(path).read().decode('utf-8')
+  
+  html = markdown2.markdown(text, extras=markdown_extras)
+  
+  # Save the render for next time, through a temporary file so that a crashed build 
+  # can't leave half an entry behind.
+  if args.cache:
+    if not os.path.exists(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+    replace_file(path, html.encode('utf-8'))
+  
+  return html
+
+# prune_cache() trims the markdown render cache down to conf['cache_size'] megabytes 
+# (100 by default), removing the least recently used renders first.
+def prune_cache():
+  limit = conf.get('cache_size', 100) * 1024 * 1024
+  
+  if not os.path.exists(cache_folder + '/markdown'):
+    return 0
+  
+  # Collect every cached render with its last use time and size.
+  entries = []
+  total = 0
+  for root, dirs, files in os.walk(cache_folder + '/markdown'):
+    for file in files:
+      st = os.stat(root + '/' + file)
+      entries.append((st.st_mtime, st.st_size, root + '/' + file))
+      total += st.st_size
+  
+  # Remove the oldest entries until we're under the limit.
+  removed = 0
+  for mtime, size, path in sorted(entries):
+    if total <= limit: break
+    os.remove(path)
+    total -= size
+    removed += 1
+  
+  if args.verbose and removed: print 'Removed ' + str(removed) + ' cached renders.'
+  return removed
+
+# The version of minify_css() and minify_js(), part of the signature of every bundle so 
+# that changing how they minify rebuilds the bundles.
+minifier_version = '1'
+
+# The tokens of a stylesheet: comments, strings, whitespace and everything else.
+css_tokens = re.compile(r'(?P<comment>/\*[\s\S]*?(?:\*/|$))|' + \
+  r'(?P<string>"(?:[^"\\\n]|\\[\s\S])*"|\'(?:[^\'\\\n]|\\[\s\S])*\')|' + \
+  r'(?P<space>\s+)|(?P<other>[^/"\'\s]+|[\s\S])')
+
+# minify_css() takes in a stylesheet and returns it minified. Comments are dropped, except
+# /*! ones, and whitespace is dropped where it can't matter and collapsed everywhere else,
+# leaving strings alone.
+def minify_css(text):
+  out = []
+  space = False
+  for match in css_tokens.finditer(text):
+    kind, token = match.lastgroup, match.group()
+    if kind == 'space' or (kind == 'comment' and not token.startswith('/*!')):
+      space = True
+      continue
+    
+    if out:
+      if kind == 'other' and token[0] == '}' and last == 'other' and out[-1][-1] == ';':
+        out[-1] = out[-1][:-1]
+      elif space and not out[-1][-1] in '{};,>~(:' and not token[0] in '{};,>~)!':
+        out.append(' ')
+    
+    if kind == 'other': token = token.replace(';}', '}')
+    out.append(token)
+    last = kind
+    space = False
+  return ''.join(out)
+
+# The tokens of a script: whitespace, comments, strings, words (identifiers, keywords, 
+# private names and numbers) and single punctuation characters. Regular expressions are 
+# told apart from division by the token before them, and template literals are found by 
+# js_template(), see minify_js().
+js_tokens = re.compile(r'(?P<space>\s+)|(?P<comment>//[^\n]*|/\*[\s\S]*?(?:\*/|$))|' + \
+  r'(?P<string>"(?:[^"\\\n]|\\[\s\S])*"|\'(?:[^\'\\\n]|\\[\s\S])*\')|' + \
+  r'(?P<word>#?[\w$\\\x80-\xff]+)|(?P<punct>[\s\S])')
+js_regex = re.compile(r'/(?![*/])(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[\w$]*')
+
+# The keywords a regular expression can follow.
+js_regex_keywords = set(['return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 
+                         'void', 'throw', 'case', 'do', 'else', 'yield', 'await'])
+
+# js_template() takes in a script and the position of a template literal in it and returns
+# the position just past its end, skipping over the ${} expressions in it along with any 
+# strings and templates inside them.
+def js_template(text, pos):
+  pos += 1
+  while pos < len(text):
+    if text[pos] == '\\':
+      pos += 2
+    elif text[pos] == '`':
+      return pos + 1
+    elif text.startswith('${', pos):
+      pos += 2
+      depth = 0
+      while pos < len(text) and (depth or text[pos] != '}'):
+        if text[pos] == '`':
+          pos = js_template(text, pos)
+          continue
+        token = js_tokens.match(text, pos).group()
+        if token == '{': depth += 1
+        if token == '}': depth -= 1
+        pos += len(token)
+      pos += 1
+    else:
+      pos += 1
+  return pos
+
+# minify_js() takes in a script and returns it minified. Comments are dropped, except /*! 
+# ones, and whitespace is dropped wherever that can't join two tokens into one. Line 
+# breaks that automatic semicolon insertion might depend on are kept. Strings and regular
+# expressions are left alone.
+def minify_js(text):
+  out = []
+  prev = None
+  space = newline = False
+  pos = 0
+  while pos < len(text):
+    if text[pos] == '`':
+      kind, token = 'string', text[pos:js_template(text, pos)]
+    else:
+      match = js_tokens.match(text, pos)
+      kind, token = match.lastgroup, match.group()
+    
+    # A / starts a regular expression anywhere a value is expected.
+    if token == '/' and (prev is None or 
+                         (prev[0] == 'word' and prev[1] in js_regex_keywords) or 
+                         (prev[0] == 'punct' and not prev[1] in ')]}')):
+      regex = js_regex.match(text, pos)
+      if regex: kind, token = 'regex', regex.group()
+    pos += len(token)
+    
+    if kind == 'space' or (kind == 'comment' and not token.startswith('/*!')):
+      space = True
+      newline = newline or '\n' in token or '\r' in token
+      continue
+    
+    if prev and space:
+      last, first = out[-1][-1], token[0]
+      ends = last.isalnum() or last in '_$\\' or last > '\x7f' or prev[0] == 'regex'
+      starts = first.isalnum() or first in '_$\\#' or first > '\x7f'
+      if newline and (ends or last in ')]}+-"\'`') and (starts or first in '([{+-!~"\'`'):
+        out.append('\n')
+      elif (ends and starts) or (last + first) in ('++', '--', '//') or \
+        (first == '.' and prev[0] == 'word' and prev[1].isdigit()):
+        out.append(' ')
+    
+    out.append(token)
+    if kind != 'comment': prev = (kind, token)
+    space = newline = False
+  return ''.join(out)
+
+# With --profile every build stage and every step of the build (parsing, rendering and 
+# writing a post, fetching a short url or making a gallery image) is timed and gathered up
+# in the profile, which is reported at the end of the build.
+profile = None
+
+# The build stages that --profile times.
+profile_stages = ['crunch_clean', 'crunch_clear_cache', 'ensure_build_folder', 
+                  'refresh_index', 'crunch_import', 'crunch_email', 'crunch_single', 
+                  'crunch_dependencies', 'crunch_errors', 'crunch_pages', 'crunch_posts', 
+                  'crunch_indexes', 'crunch_home', 'crunch_feed', 'crunch_extras', 
+                  'crunch_gallery_all', 'crunch_gzip']
+
+# start_profile() sets up the profile and wraps each of the build stages so that they are
+# timed when they run.
+def start_profile():
+  global profile
+  profile = {'stages': [], 'steps': []}
+  for name in profile_stages:
+    globals()[name] = profile_stage(name, globals()[name])
+
+# profile_stage() takes in the name of a build stage and its function and returns a 
+# function that runs the stage and records its wall and cpu time, along with the peak 
+# memory of crunch and its workers so far. Python 2 has no tracemalloc, so the peak is the
+# resident set size from getrusage().
+def profile_stage(name, function):
+  def stage(*arguments, **keywords):
+    wall, cpu = time.time(), time.clock()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+      return function(*arguments, **keywords)
+    finally:
+      usage = resource.getrusage(resource.RUSAGE_SELF)
+      child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+      profile['stages'].append({
+        'stage': name, 
+        'wall': time.time() - wall, 
+        'cpu': time.clock() - cpu,
+        'worker_cpu': child_usage.ru_utime + child_usage.ru_stime - children.ru_utime - 
+                      children.ru_stime,
+        'peak_kb': usage.ru_maxrss, 
+        'worker_peak_kb': child_usage.ru_maxrss})
+  stage.__name__ = name
+  return stage
+
+# profile_step() records a step of the build if --profile is set. Takes in the kind of 
+# step, what it worked on and the wall and cpu times it started at.
+def profile_step(kind, name, wall, cpu):
+  if profile is None: return
+  profile['steps'].append({'kind': kind, 'name': name, 'wall': time.time() - wall, 
+                           'cpu': time.clock() - cpu})
+
+# take_steps() returns the steps recorded so far and forgets them. Worker processes use it 
+# to send their steps back to the parent.
+def take_steps():
+  if profile is None: return None
+  steps = profile['steps'][:]
+  del profile['steps'][:]
+  return steps
+
+# report_profile() prints a summary of the profile, slowest first, and writes the whole 
+# thing out as JSON to the file named by --profile.
+def report_profile():
+  stages = sorted(profile['stages'], key=lambda stage: stage['wall'], reverse = True)
+  
+  print 'Stages:'
+  for stage in stages:
+    print '  %-20s %9.3fs wall %9.3fs cpu %9.3fs workers %8.1f MB peak' % (stage['stage'],
+      stage['wall'], stage['cpu'], stage['worker_cpu'], stage['peak_kb'] / 1024.0)
+  
+  # Add up each kind of step.
+  totals = {}
+  steps = {}
+  for step in profile['steps']:
+    total = totals.setdefault(step['kind'], {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+    total['count'] += 1
+    total['wall'] += step['wall']
+    total['cpu'] += step['cpu']
+    
+    entry = steps.setdefault(step['kind'], {}).setdefault(step['name'], 
+                                                         {'wall': 0.0, 'cpu': 0.0})
+    entry['wall'] += step['wall']
+    entry['cpu'] += step['cpu']
+  
+  print 'Steps:'
+  for kind, total in sorted(totals.items(), key=lambda item: item[1]['wall'], 
+                            reverse = True):
+    print '  %-8s %6d x %9.3fs wall %9.3fs cpu' % (kind, total['count'], total['wall'], 
+                                                   total['cpu'])
+  
+  print 'Slowest steps:'
+  for step in sorted(profile['steps'], key=lambda step: step['wall'], reverse = True)[:10]:
+    print '  %-8s %9.3fs  %s' % (step['kind'], step['wall'], step['name'])
+  
+  report = {'stages': profile['stages'], 'totals': totals, 'steps': steps, 
+            'jobs': args.jobs, 'cache': args.cache, 'incremental': args.incremental}
+  f = open(os.path.join(base_folder, args.profile), 'w')
+  json.dump(report, f, indent=2, sort_keys=True)
+  f.close()
+  print 'Wrote the profile to ' + args.profile + '.'
+
+# read_header() returns the yaml header of a post file, reading no further than the blank
+# line that ends it.
+def read_header(path):
+  header = []
+  f = open(path)
+  for line in f:
+    if line == '\n': break
+    header.append(line)
+  f.close()
+  return ''.join(header)
+
+# make_slug() turns a post title into the slug used for its url and filename.
+def make_slug(title):
+  return re.sub('\-{2,}', '-', re.sub('[^a-z0-9-]', '', re.sub('\s', '-', \
+                re.sub('&', 'and', str(title).lower()))))
+
+# post_link() returns the full url of a post from its time tuple and slug.
+def post_link(post_time, slug):
+  return conf['base_url'] + time.strftime('%Y/%m/', post_time) + slug
+
+# The short url store maps the full url of every post to its amd.im code, so that each post
+# only ever costs a single request to the shortener. Urls the shortener failed on are 
+# remembered for the rest of the run so a slow shortener can only hold us up once. With 
+# --watch they are tried again on every rebuild.
+shorts_file = cache_folder + '/shorts.json'
+shorts = None
+short_failures = set()
+short_local = threading.local()
+
+# get_shorts() loads the short url store on first use and returns it.
+def get_shorts():
+  global shorts
+  if shorts is None:
+    try:
+      shorts = json.load(open(shorts_file))
+    except:
+      shorts = {}
+  return shorts
+
+# save_shorts() writes the short url store back out, if it was used during this run.
+def save_shorts():
+  if shorts is None: return
+  if not os.path.exists(cache_folder): os.makedirs(cache_folder)
+  replace_file(shorts_file, json.dumps(shorts))
+
+# fetch_short() asks the shortener for the code of a url and returns it, or None if the 
+# request failed. Each thread keeps its connection to the shortener open between requests.
+def fetch_short(url):
+  wall, cpu = time.time(), time.clock()
+  try:
+    return request_short(url)
+  finally:
+    profile_step('http', url, wall, cpu)
+
+# request_short() does the work for fetch_short().
+def request_short(url):
+  shortener = urlparse.urlsplit(conf.get('shortener_url', 'http://amd.im/api-create/'))
+  
+  # Try twice, the server may have closed a connection we kept open.
+  for attempt in range(2):
+    connection = getattr(short_local, 'connection', None)
+    if connection is None:
+      connection = httplib.HTTPConnection(shortener.netloc, 
+                                          timeout=conf.get('short_timeout', 5))
+      short_local.connection = connection
+    
+    try:
+      connection.request('GET', shortener.path + url)
+      response = connection.getresponse()
+      code = response.read().strip()
+      if response.status != 200:
+        print 'ERROR: Shortener returned ' + str(response.status) + ' for ' + url
+        return None
+      return re.sub('^https?://[^/]+/', '', code)
+    except socket.timeout:
+      print 'ERROR: Shortener timed out for ' + url
+      connection.close()
+      short_local.connection = None
+      return None
+    except (httplib.HTTPException, socket.error):
+      connection.close()
+      short_local.connection = None
+  
+  print 'ERROR: Could not reach the shortener for ' + url
+  return None
+
+# fetch_shorts() takes in a list of urls and fetches the codes for any that aren't in 
+# the store yet, conf['short_workers'] (4 by default) at a time.
+def fetch_shorts(urls):
+  store = get_shorts()
+  urls = sorted(set([url for url in urls if not url in store and 
+                     not url in short_failures]))
+  if not urls: return
+  if args.verbose: print 'Fetching ' + str(len(urls)) + ' short url(s).'
+  
+  # A single url is fetched right here so its connection can be used again later.
+  if len(urls) == 1:
+    codes = [fetch_short(urls[0])]
+  else:
+    pool = ThreadPool(min(conf.get('short_workers', 4), len(urls)))
+    try:
+      codes = pool.map(fetch_short, urls)
+    finally:
+      pool.close()
+      pool.join()
+  
+  for url, code in zip(urls, codes):
+    if code:
+      store[url] = code
+    else:
+      short_failures.add(url)
+
+# get_short() takes in the full url of a post and returns its short code from the store, 
+# fetching it from the shortener if HTTP is enabled. Returns None if there is no code.
+def get_short(url):
+  if not url in get_shorts() and args.http:
+    fetch_shorts([url])
+  return get_shorts().get(url)
+
+# The post catalog holds every parsed post keyed by its (year, month, filename) and the 
+# sorted posts for each (year, month) folder. It is filled lazily by get_post() and 
+# get_month() and shared by every builder, so each post file is read and parsed at most 
+# once per run no matter how many pages it ends up on.
+post_catalog = {}
+month_catalog = {}
+
+# The post index is a sqlite database in the cache folder holding the header of every post
+# along with the mtime and size of its file. It is brought up to date with the posts folder
+# on first use, only reading the headers of posts that are new or have changed, so the 
+# builders can list and sort the posts without opening any post files. It also keeps the 
+# formatted fragments of the posts, see post_fragment().
+index_file = cache_folder + '/posts.db'
+index_version = 2
+index = None
+index_current = False
+
+# index_text() turns text coming out of the post index back into the kind of string yaml
+# gave for the header, a plain string unless it has to be unicode.
+def index_text(data):
+  try:
+    data.decode('ascii')
+    return data
+  except UnicodeDecodeError:
+    return data.decode('utf-8')
+
+# open_index() connects to the post index, starting it over if it's unreadable or from an
+# older version of crunch.
+def open_index():
+  if not os.path.exists(cache_folder): os.makedirs(cache_folder)
+  
+  db = sqlite3.connect(index_file)
+  db.text_factory = index_text
+  try:
+    version = db.execute('pragma user_version').fetchone()[0]
+  except sqlite3.DatabaseError:
+    db.close()
+    os.remove(index_file)
+    db = sqlite3.connect(index_file)
+    db.text_factory = index_text
+    version = None
+  
+  if version != index_version:
+    db.execute('drop table if exists posts')
+    db.execute('drop table if exists fragments')
+    db.execute('create table posts (year text, month text, file text, mtime real, ' + \
+               'size integer, title text, time real, slug text, short text, ' + \
+               'primary key (year, month, file))')
+    db.execute('create index posts_time on posts (year, month, time)')
+    db.execute('create table fragments (year text, month text, file text, kind text, ' + \
+               'key text, html text, primary key (year, month, file, kind))')
+    db.execute('pragma user_version = ' + str(index_version))
+    db.commit()
+  return db
+
+# get_index() returns the post index, bringing it up to date first if it hasn't been yet.
+def get_index():
+  global index, index_current
+  if index is None: index = open_index()
+  if not index_current:
+    refresh_index(index)
+    index_current = True
+  return index
+
+# refresh_years() takes in a set of years that have had posts written to them and brings 
+# the post index up to date for just those years, so that publishing a post doesn't mean
+# walking the whole posts folder. The rest of the index is taken as it was left by the 
+# last build, unless there isn't one yet.
+def refresh_years(years):
+  global index, index_current
+  if index is None: index = open_index()
+  post_catalog.clear()
+  month_catalog.clear()
+  
+  # With nothing indexed yet, the whole posts folder has to be.
+  if index.execute('select 1 from posts limit 1').fetchone() is None:
+    index_current = False
+  else:
+    refresh_index(index, years)
+    index_current = True
+
+# save_index() commits any fragments added to the post index during this run.
+def save_index():
+  if index is not None: index.commit()
+
+# forget_posts() drops everything known about the posts so the next query goes back to 
+# the posts folder. Used when a post file has been written during the run.
+def forget_posts():
+  global index_current
+  post_catalog.clear()
+  month_catalog.clear()
+  index_current = False
+
+# refresh_index() brings the post index up to date with the posts folder. Every post file 
+# is stat()ed, but only the headers of new or changed posts are read. Any short urls they
+# are missing are fetched in one batch before they get indexed. Posts that were indexed 
+# without a short url are tried again. Takes in an optional set of years to limit it to.
+def refresh_index(db, years=None):
+  known = {}
+  for year, month, file, mtime, size, short in \
+    db.execute('select year, month, file, mtime, size, short from posts'):
+    if years is None or year in years:
+      known[(year, month, file)] = (mtime, size, short)
+  
+  # Walk the posts folder looking for posts that aren't indexed as they are now.
+  stale = []
+  for year in os.listdir(posts_folder):
+    if not re.match('\d\d\d\d', year): continue
+    if years is not None and not year in years: continue
+    for month in os.listdir(posts_folder + '/' + year):
+      if not re.match('\d\d', month): continue
+      for file in os.listdir(posts_folder + '/' + year + '/' + month):
+        if not file.endswith(conf['extension']): continue
+        
+        st = os.stat(post_source(year, month, file))
+        entry = known.pop((year, month, file), None)
+        if entry is None or entry[0] != st.st_mtime or entry[1] != st.st_size or \
+          (args.http and not entry[2]):
+          stale.append((year, month, file, st))
+  
+  # Fetch the short urls of the stale posts that don't have one in the header.
+  if args.http:
+    urls = []
+    for year, month, file, st in stale:
+      header = read_header(post_source(year, month, file))
+      if re.search('^short:', header, re.M): continue
+      y = yaml.load(header)
+      urls.append(post_link(time.localtime(y['date']), make_slug(y['title'])))
+    fetch_shorts(urls)
+  
+  for year, month, file, st in stale:
+    p = Post()
+    p.load(post_source(year, month, file))
+    db.execute('insert or replace into posts values (?, ?, ?, ?, ?, ?, ?, ?, ?)', 
+               (year, month, file, st.st_mtime, st.st_size, p.title, time.mktime(p.time), 
+                p.slug, p.short))
+  
+  # Whatever is left over has been deleted.
+  for year, month, file in known:
+    db.execute('delete from posts where year = ? and month = ? and file = ?', 
+               (year, month, file))
+    db.execute('delete from fragments where year = ? and month = ? and file = ?', 
+               (year, month, file))
+  db.commit()
+  
+  if args.verbose and (stale or known): 
+    print 'Indexed ' + str(len(stale)) + ' posts, removed ' + str(len(known)) + '.'
+
+# index_post() takes in a year, month and post index row of (file, title, time, slug, 
+# short, mtime, size) and returns the post object for it from the catalog, making it if 
+# it's new.
+def index_post(year, month, row):
+  if not (year, month, row[0]) in post_catalog:
+    p = Post()
+    p.filename, p.title, p.slug, p.short = row[0], row[1], row[3], row[4]
+    p.time = time.localtime(row[2])
+    p.source = post_source(year, month, p.filename)
+    p.markdown = None
+    p.index_row = (year, month) + tuple(row)
+    post_catalog[(year, month, row[0])] = p
+  return post_catalog[(year, month, row[0])]
+
+# post_years() returns the years that have posts in reverse order.
+def post_years():
+  return [row[0] for row in 
+          get_index().execute('select distinct year from posts order by year desc')]
+
+# post_months() returns the months of a year that have posts in reverse order.
+def post_months(year):
+  return [row[0] for row in get_index().execute('select distinct month from posts ' + \
+          'where year = ? order by month desc', (year,))]
+
+# post_files() returns the post filenames in a month folder, only those with the correct 
+# extension per `conf.yaml`.
+def post_files(year, month):
+  return [row[0] for row in get_index().execute('select file from posts ' + \
+          'where year = ? and month = ? order by file', (year, month))]
+
+# get_post() takes in a year, month and post filename and returns the post object. Its 
+# header comes from the post index and its body is rendered when it's needed.
+def get_post(year, month, file):
+  if not (year, month, file) in post_catalog:
+    row = get_index().execute('select file, title, time, slug, short, mtime, size ' + \
+                              'from posts ' + \
+                              'where year = ? and month = ? and file = ?', 
+                              (year, month, file)).fetchone()
+    if row: return index_post(year, month, row)
+    
+    # The post isn't indexed, so read its header.
+    p = Post()
+    p.filename = file
+    p.load(post_source(year, month, file))
+    post_catalog[(year, month, file)] = p
+    
+  return post_catalog[(year, month, file)]
+
+# get_month() takes in a year and month folder name and returns the post objects for 
+# that folder in reverse chronological order.
+def get_month(year, month):
+  if not (year, month) in month_catalog:
+    month_catalog[(year, month)] = [index_post(year, month, row) for row in 
+      get_index().execute('select file, title, time, slug, short, mtime, size ' + \
+                          'from posts where year = ? and month = ? ' + \
+                          'order by time desc, file', (year, month))]
+  return month_catalog[(year, month)]
+
+# get_catalog() returns a list of (year, month, posts) tuples for the whole posts folder 
+# in reverse order.
+def get_catalog():
+  return [(year, month, get_month(year, month)) for year in post_years() 
+          for month in post_months(year)]
+
+# recent_rows() returns the year, month and post index row of the newest count posts, 
+# newest first.
+def recent_rows(count):
+  return [(row[0], row[1], row[2:]) for row in 
+    get_index().execute('select year, month, file, title, time, slug, short, mtime, ' + \
+                        'size from posts order by year desc, month desc, time desc, file ' + \
+                        'limit ?', (count,))]
+
 # get_recent() takes in an integer that sets the number of recent posts to get, it 
 # returns a list of post objects in reverse chronological order. This function is used
 # in crunch_feed() and crunch_home().
 def get_recent(count):
-  # Create an empty variable to store posts in.
-  post_list = []
-      
-  # Get all the years in reverse order.
-  for year in sorted(os.listdir(posts_folder), reverse = True):
-
-    # Make sure we're using a year folder.
-    if re.match('\d\d\d\d', year): 
-      
-      # Get all the months for the year in reverse order.
-      for month in sorted(os.listdir(posts_folder + '/' + year), reverse = True):
-        
-        # Make sure we're working with a month folder:
-        if re.match('\d\d', month):
-          
-          # Make a temporary list.
-          tmp = []
-          
-          # Grab all the posts in the folder in no particular order.
-          for file in os.listdir(posts_folder + '/' + year + '/' + month):
-            
-            # Ensure we're only grabbing files with the correct extension.
-            if file.endswith(conf['extension']):
-              
-              # Make a new post object
-              p = Post()
-              
-              # Open the file.
-              f = open(posts_folder + '/' + year + '/' + month + '/' + file)
-              
-              # Set the filename.
-              p.filename = file
-              
-              # Parse the post.
-              p.parse(f.read())
-              
-              # Add the post to the tmp list
-              tmp.append(p)
-          
-          # Process this month's posts and add them to the empty variable in reverse
-          # chronological order.
-          for post in sorted(tmp, key=lambda p: p.time, reverse = True):
-            if len(post_list) >= count: break
-            post_list.append(post)
-            
-        if len(post_list) >= count:
-          break
+  return [index_post(year, month, row) for year, month, row in recent_rows(count)]
+
+
+# fragment_salt() returns everything besides the post itself that goes into its fragments:
+# the templates, the markdown renderer and `conf.yaml`.
+fragment_salt_cache = None
+def fragment_salt():
+  global fragment_salt_cache
+  if fragment_salt_cache is None:
+    fragment_salt_cache = '\n'.join([template_signature(), renderer_version, 
+                                     ','.join(markdown_extras), 
+                                     file_signature(conf_file) or ''])
+  return fragment_salt_cache
+
+# post_fragment() takes in a post and a kind, 'html' or 'xml', and returns post.formatted()
+# or post.xml(). Fragments of indexed posts are kept in the post index keyed by their index
+# row, so an index page, the home page or the feed can be put back together from them 
+# without opening or rendering the posts on it again.
+def post_fragment(post, kind):
+  make = kind == 'xml' and post.xml or post.formatted
+  if not args.cache or post.index_row is None: return make()
+  
+  key = hashlib.sha1(fragment_salt() + '\n' + repr(post.index_row)).hexdigest()
+  where = post.index_row[:3] + (kind,)
+  row = get_index().execute('select key, html from fragments where year = ? and ' + \
+                            'month = ? and file = ? and kind = ?', where).fetchone()
+  if row and row[0] == key: return row[1]
+  
+  html = make()
+  get_index().execute('insert or replace into fragments values (?, ?, ?, ?, ?, ?)', 
+                      where + (key, html))
+  return html
+
+
+# The build manifest records, for every target crunch writes (a post page, a month or 
+# year index, the archives, home page or feed), the output file and the signatures of the 
+# sources it was built from. --incremental uses it to skip any target whose sources are 
+# unchanged since the last build. It also remembers the hash of every source file against
+# its mtime and size so unchanged files don't have to be read again.
+manifest_file = cache_folder + '/manifest.json'
+manifest = None
+
+# get_manifest() loads the build manifest on first use and returns it.
+def get_manifest():
+  global manifest
+  if manifest is None:
+    try:
+      manifest = json.load(open(manifest_file))
+    except:
+      manifest = {'files': {}, 'targets': {}}
+  return manifest
+
+# save_manifest() writes the build manifest back out, if it was used during this run.
+def save_manifest():
+  if manifest is None: return
+  if not os.path.exists(cache_folder): os.makedirs(cache_folder)
+  replace_file(manifest_file, json.dumps(manifest))
+
+# file_signature() returns the sha1 of a file's content, or None if it doesn't exist.
+def file_signature(path):
+  files = get_manifest()['files']
+  name = os.path.relpath(path, base_folder)
+  
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  
+  # Reuse the known hash if the file looks untouched.
+  known = files.get(name)
+  if known and known[0] == st.st_mtime and known[1] == st.st_size:
+    return known[2]
+  
+  f = open(path, 'rb')
+  digest = hashlib.sha1(f.read()).hexdigest()
+  f.close()
+  files[name] = [st.st_mtime, st.st_size, digest]
+  return digest
+
+# template_signature() returns a hash of the source of all the template functions, so 
+# that changing a template invalidates everything built with it.
+template_hash = None
+def template_signature():
+  global template_hash
+  if template_hash is None:
+    templates = [inspect.getsource(f) for name, f in sorted(globals().items()) 
+                 if name.startswith('format_')]
+    template_hash = hashlib.sha1(''.join(templates)).hexdigest()
+  return template_hash
+
+# target_signatures() takes in a list of source files and returns a dict of their 
+# signatures. The special source 'templates' stands for the template functions, along with
+# the bundles every page links to, and 'minifier' for minify_css() and minify_js(). Post 
+# files are signed along with their short code, which can turn up after the post was built.
+def target_signatures(sources):
+  signatures = {}
+  for source in sources:
+    if source == 'templates':
+      signatures[source] = template_signature() + ' ' + bundle_url('css') + ' ' + \
+        bundle_url('js')
+    elif source == 'minifier':
+      signatures[source] = minifier_version
+    elif source.startswith(posts_folder + '/'):
+      signatures[os.path.relpath(source, base_folder)] = [file_signature(source), 
+                                                          post_short(source)]
+    else:
+      signatures[os.path.relpath(source, base_folder)] = file_signature(source)
+  return signatures
+
+# is_current() returns True if --incremental is set and the target was last built from 
+# exactly these sources, unchanged, into an output file that still exists.
+def is_current(target, sources):
+  if not args.incremental: return False
+  return is_built(target, sources)
+
+# is_built() returns True if the target was last built from exactly these sources, 
+# unchanged, into an output file that still exists, whether or not --incremental is set.
+def is_built(target, sources):
+  entry = get_manifest()['targets'].get(target)
+  return entry is not None and os.path.exists(base_folder + '/' + entry['output']) and \
+    entry['sources'] == target_signatures(sources)
+
+# record_target() notes in the manifest that a target has been written to output from
+# sources. Any extra keyword arguments are stored with it.
+def record_target(target, output, sources, **extra):
+  entry = {'output': os.path.relpath(output, base_folder), 
+           'sources': target_signatures(sources)}
+  entry.update(extra)
+  get_manifest()['targets'][target] = entry
+
+# post_source() returns the full path of a post file.
+def post_source(year, month, file):
+  return posts_folder + '/' + year + '/' + month + '/' + file
+
+# post_short() returns the short code of a post file as the post index has it.
+def post_short(path):
+  year, month, file = os.path.relpath(path, posts_folder).split('/')
+  return get_post(year, month, file).short
+
+# post_sources() returns the source list for a page built from the given post files.
+def post_sources(files):
+  return files + [conf_file, 'templates']
+
+# recent_sources() returns the post files that get_recent(count) would return.
+def recent_sources(count):
+  return [post_source(year, month, row[0]) for year, month, row in recent_rows(count)]
+
+# replace_file() writes data to a temporary file next to path and renames it into place,
+# so nobody ever sees a half written file.
+def replace_file(path, data):
+  tmp = path + '.' + str(os.getpid()) + '.tmp'
+  f = open(tmp, 'wb')
+  f.write(data)
+  f.close()
+  os.chmod(tmp, 0644)
+  os.rename(tmp, path)
+
+# Counts of the outputs written and skipped by Output_File during this run.
+output_counts = {'written': 0, 'skipped': 0}
+
+# write_output() writes a page to filename unless the file already holds exactly the same
+# content, in which case it's left alone with its old mtime. Returns True if it wrote.
+def write_output(filename, content):
+  f = Output_File(filename)
+  f.write(content)
+  return f.close()
+
+# write_page() streams a page to filename wrapped in the layout, with the body made up of 
+# fragments (any iterable of strings) instead of page.body, so the body never has to be 
+# held in memory in one piece. Returns True if it wrote.
+def write_page(filename, page, fragments):
+  prefix, middle, suffix = layout_chunks(page.author, page.description)
+  f = Output_File(filename)
+  f.write(prefix)
+  f.write(page.title)
+  f.write(middle)
+  for fragment in fragments:
+    f.write(fragment)
+  f.write(suffix)
+  return f.close()
+
+# write_index() writes out a year or month index page into folder, streaming the posts 
+# into the body in the order given. If index_page_size is set in `conf.yaml` the posts are
+# split across folder/index.htm, folder/page/2.htm and so on, each linking to its 
+# neighbours, and any pages left over from a longer index are removed. Returns the 
+# filename of the first page.
+def write_index(folder, url, title, posts):
+  size = conf.get('index_page_size', 0) or len(posts) or 1
+  pages = [posts[i:i + size] for i in range(0, len(posts), size)] or [[]]
+  
+  # The first page is the folder's index.htm, the rest are numbered from 2.
+  def page_url(number):
+    if number == 1: return url
+    return url + 'page/' + str(number)
+  def page_file(number):
+    if number == 1: return folder + '/index.htm'
+    return folder + '/page/' + str(number) + '.htm'
+  
+  if len(pages) > 1 and not os.path.exists(folder + '/page'): os.makedirs(folder + '/page')
+  
+  for number, page_posts in enumerate(pages, 1):
+    page = Page()
+    if number > 1: 
+      page.title = title + ', page ' + str(number) + ' | ' + page.title
+    else:
+      page.title = title + ' | ' + page.title
     
-    if len(post_list) >= count:
-      break
-      
-  return post_list
-
+    fragments = (post_fragment(post, 'html') for post in page_posts)
+    if len(pages) > 1:
+      fragments = itertools.chain(fragments, [format_pagination(
+        number > 1 and page_url(number - 1) or None, 
+        number < len(pages) and page_url(number + 1) or None)])
+    write_page(page_file(number), page, fragments)
+  
+  # Clear out pages past the end of the index.
+  if os.path.exists(folder + '/page'):
+    for name in os.listdir(folder + '/page'):
+      match = re.match('(\d+)\.htm$', name)
+      if match and int(match.group(1)) > len(pages):
+        os.remove(folder + '/page/' + name)
+        if args.verbose: print '\tRemoved ' + folder + '/page/' + name
+  
+  return page_file(1)
+
+# reflink() clones source to destination sharing the same blocks on disk, on filesystems
+# that support it (btrfs, xfs). Raises IOError anywhere else.
+def reflink(source, destination):
+  import fcntl
+  s = open(source, 'rb')
+  d = open(destination, 'wb')
+  try:
+    # FICLONE from linux/fs.h.
+    fcntl.ioctl(d.fileno(), 0x40049409, s.fileno())
+  finally:
+    s.close()
+    d.close()
+  shutil.copystat(source, destination)
+
+# sync_file() makes destination a copy of source unless it already matches it in size and 
+# modification time, and returns True if it had to write it. With conf['sync_mode'] set to
+# hardlink or reflink the file is linked or cloned instead of copied wherever the 
+# filesystem allows it, falling back to a copy.
+def sync_file(source, destination):
+  st = os.stat(source)
+  try:
+    dt = os.stat(destination)
+    if dt.st_size == st.st_size and int(dt.st_mtime) == int(st.st_mtime):
+      return False
+  except OSError:
+    pass
+  
+  # Write through a temporary file so the old copy stays in place until the new one is 
+  # complete.
+  tmp = destination + '.' + str(os.getpid()) + '.tmp'
+  linked = False
+  mode = conf.get('sync_mode', 'copy')
+  if mode == 'hardlink' or mode == 'reflink':
+    try:
+      if mode == 'hardlink':
+        os.link(source, tmp)
+      else:
+        reflink(source, tmp)
+      linked = True
+    except (OSError, IOError):
+      if os.path.exists(tmp): os.remove(tmp)
+  if not linked:
+    shutil.copy2(source, tmp)
+  os.rename(tmp, destination)
+  return True
+
+# sync_files() takes in a source folder, a destination folder, a list of file names 
+# relative to source and a key naming the set. It syncs every file and removes any file 
+# that was synced under the same key last time but is no longer in the list. Returns the 
+# names of the files removed.
+def sync_files(source, destination, names, key):
+  synced = get_manifest().setdefault('synced', {})
+  
+  copied = 0
+  for name in names:
+    if not os.path.exists(os.path.dirname(destination + '/' + name)):
+      os.makedirs(os.path.dirname(destination + '/' + name))
+    if sync_file(source + '/' + name, destination + '/' + name):
+      if args.verbose: print '\tCopying ' + name
+      copied += 1
+  
+  # Clear out what has gone from the source since the last sync.
+  removed = sorted(set([name.encode('utf-8') for name in synced.get(key, [])]) - 
+                   set(names))
+  for name in removed:
+    if os.path.exists(destination + '/' + name):
+      if args.verbose: print '\tRemoving ' + name
+      os.remove(destination + '/' + name)
+  synced[key] = sorted(names)
+  
+  if args.verbose: print 'Synced ' + key + ': ' + str(copied) + ' copied, ' + \
+    str(len(names) - copied) + ' unchanged, ' + str(len(removed)) + ' removed.'
+  return removed
+
+# sync_tree() syncs every file under the source folder into the destination folder, see 
+# sync_files().
+def sync_tree(source, destination, key):
+  names = []
+  for root, dirs, files in os.walk(source):
+    # Mirror the folders too, even the empty ones.
+    for dir in dirs:
+      if not os.path.exists(destination + '/' + os.path.relpath(root + '/' + dir, source)):
+        os.makedirs(destination + '/' + os.path.relpath(root + '/' + dir, source))
+    for file in files:
+      names.append(os.path.relpath(root + '/' + file, source))
+  return sync_files(source, destination, sorted(names), key)
 
 ##########################################################################################
 ### Build Functions
 ##########################################################################################
 
 # Function to ensure that the build folder exists for use. Creates one from the parent 
-# folders if it does not exist.
+# folders if it does not exist, and brings it up to date with them if it does.
 def ensure_build_folder():
-  if os.path.exists(build_folder):
-    return 0
-  else:
-    shutil.copytree(public_folder, build_folder)
-    shutil.copytree(images_folder, build_folder + '/' + conf['images_folder'])
-    os.mkdir(build_folder + '/' + conf['galleries_folder'])
-    os.mkdir(build_folder + '/' + conf['css_folder'])
-    os.mkdir(build_folder + '/' + conf['scripts_folder'])
+  created = not os.path.exists(build_folder)
+  
+  # Bring over anything new or changed in the public and images folders.
+  sync_tree(public_folder, build_folder, 'public')
+  sync_tree(images_folder, build_folder + '/' + conf['images_folder'], 'images')
+  
+  for folder in [conf['galleries_folder'], conf['css_folder'], conf['scripts_folder']]:
+    if not os.path.exists(build_folder + '/' + folder):
+      os.mkdir(build_folder + '/' + folder)
+  
+  if created:
     return 2
-  return 1
+  return 0
 
 # Generate error pages.
 def crunch_errors():
@@ -530,9 +1610,7 @@ def crunch_errors():
     page.title = 'Error ' + error + ' | ' + page.title
     page.body = format_error(error)
     
-    f = open(build_folder + '/error/' + error + '.htm', 'w')
-    f.writelines(page.formatted())
-    f.close
+    write_output(build_folder + '/error/' + error + '.htm', page.formatted())
 
 # Process pages.
 def crunch_pages(): 
@@ -552,7 +1630,7 @@ def crunch_pages():
       y = yaml.load(header)
       
       # Parse the post and grab the content.
-      content = markdown2.markdown(body, extras=["code-color", "code-friendly"])
+      content = render_markdown(body)
       
       # Pull the title out of the metadata.
       title = y['title']
@@ -569,51 +1647,103 @@ def crunch_pages():
       page.body = body
       
       # Make a new file and write out the page.
-      n = open(build_folder + url, 'w')
-      n.writelines(page.formatted())
-      n.close
-      os.chmod(build_folder + url, 0644)
+      write_output(build_folder + url, page.formatted())
       
 
 
+# crunch_post_file() writes out the page of a single post, returning the post object and 
+# the filename of its page.
+def crunch_post_file(post):
+  if args.verbose: print '\t' + post.filename
+  return post, write_post(post)
+
+# crunch_post_job() runs crunch_post_file() in a worker process. Everything it prints, its
+# output counts and any error are gathered up and returned so that the parent can report 
+# them in order.
+def crunch_post_job(task):
+  sys.stdout = StringIO()
+  output_counts['written'] = output_counts['skipped'] = 0
+  take_steps()
+  try:
+    try:
+      post, filename = crunch_post_file(task)
+      return post, filename, sys.stdout.getvalue(), None, dict(output_counts, 
+                                                               steps=take_steps())
+    except:
+      return None, None, sys.stdout.getvalue(), traceback.format_exc(), None
+  finally:
+    sys.stdout = sys.__stdout__
+
 # Processes all posts. 
 def crunch_posts():
   if args.verbose: print 'Building the posts.'
   
-  # Get every year in the posts folder.
-  for year in os.listdir(posts_folder):
-    # Ensure we're not processing some errant folder that isn't a 'year'
-    if re.match('\d\d\d\d', year):
-      if args.verbose: print 'Building ' + year + ':'
-
-      # Build a corresponding year folder in the build folder.
-      year_path = build_folder + '/' + year
-      if not os.path.exists(year_path): os.makedirs(year_path)
+  # Find every post that has changed.
+  tasks = []
+  for year in post_years():
+    for month in post_months(year):
+      # Build a corresponding month folder in the build/year folder.
+      month_path = build_folder + '/' + year + '/' + month
+      if not os.path.exists(month_path): os.makedirs(month_path)
       
-      # Get every month in the year folder.
-      for month in os.listdir(posts_folder + '/' + year):
-        if re.match('\d\d', month):
-          if args.verbose: print "\t" + month + ':'
-
-          # Build a corresponding month folder in the build/year folder.
-          month_path = build_folder + '/' + year + '/' + month
-          if not os.path.exists(month_path): os.makedirs(month_path)
-          
-          # Grab every post in the month folder.
-          for i in os.listdir(posts_folder + '/' + year + '/' + month):
-            
-            # Only process files with the correct extension per `conf.yaml`.
-            if i.endswith(conf['extension']):
-              if args.verbose: print '\t\t' + i
-              
-              # Process the post
-              crunch_single(open(posts_folder + '/' + year + '/' + month \
-                + '/' + i).read())
+      for file in post_files(year, month):
+        if not is_current('post:' + year + '/' + month + '/' + file, 
+                          post_sources([post_source(year, month, file)])):
+          tasks.append((year, month, file))
+  
+  # Build the posts, spread across a pool of processes if --jobs asks for one. Results 
+  # come back in order either way. The workers are handed the posts from the catalog 
+  # rather than looking them up in the post index themselves.
+  posts = [get_post(*task) for task in tasks]
+  pool = None
+  if args.jobs > 1 and len(tasks) > 1:
+    # Work out the layout first, so the workers don't each have to check the bundles.
+    layout_chunks(Page.author, Page.description)
+    pool = multiprocessing.Pool(args.jobs)
+    results = pool.imap(crunch_post_job, posts, max(1, len(tasks) / (args.jobs * 4)))
+  else:
+    results = itertools.imap(lambda post: crunch_post_file(post) + ('', None, None), 
+                             posts)
+  
+  folder = None
+  for year, month, file in tasks:
+    if args.verbose and folder != (year, month): print 'Building ' + year + '/' + month + ':'
+    folder = (year, month)
+    
+    post, filename, log, error, counts = results.next()
+    sys.stdout.write(log)
+    
+    # Stop the build on the first error, just like a build without --jobs would.
+    if error:
+      pool.terminate()
+      sys.stderr.write(error)
+      sys.exit(1)
+    
+    # Add up what the worker wrote.
+    if counts:
+      output_counts['written'] += counts['written']
+      output_counts['skipped'] += counts['skipped']
+      if counts['steps']: profile['steps'].extend(counts['steps'])
+    
+    # Keep the post in the catalog so nothing else has to parse it again.
+    post_catalog[(year, month, file)] = post
+    record_target('post:' + year + '/' + month + '/' + file, filename, 
+                  post_sources([post_source(year, month, file)]))
+  
+  if pool:
+    pool.close()
+    pool.join()
 
 # Function to process the home file.
 def crunch_home():
   if args.verbose: print 'Building the home page.'  
   
+  # Skip the home page if none of the posts on it have changed.
+  sources = post_sources(recent_sources(conf['home_count']))
+  if is_current('home', sources):
+    if args.verbose: print '\tHome page is current.'
+    return
+  
   # Grab the recent posts.
   if args.verbose: print '\tGet all the required posts.'
   postlist = get_recent(conf['home_count'])
@@ -621,21 +1751,13 @@ def crunch_home():
   # Create the home page. 
   if args.verbose: print '\tWriting the home page.'
   home = Page()
-  
-  # Make an empty home variable
-  home.body = ''
 
-  # Sort the posts by their actual timestamps and then assemble the most recent formatted 
-  # posts into the body of the page. The post count is determined by the home_count 
-  # variable in the configuration file.
-  for p in postlist:
-    home.body += p.formatted()
-  
-  # Write out the home page. 
-  h = open(build_folder + '/index.htm', 'w')
-  h.writelines(home.formatted())
-  h.close()
-  os.chmod(build_folder + '/index.htm', 0644)
+  # Write out the home page, streaming the most recent formatted posts into the body of 
+  # the page. The post count is determined by the home_count variable in the 
+  # configuration file.
+  write_page(build_folder + '/index.htm', home, 
+             (post_fragment(p, 'html') for p in postlist))
+  record_target('home', build_folder + '/index.htm', sources)
             
   
 # Function to create all the index pages for the month and year folders. 
@@ -644,121 +1766,99 @@ def crunch_home():
 def crunch_indexes():
   if args.verbose: print 'Building the indexes.'
   
-  # Start the body for the archives.htm page.
-  archives_body = '\t<div class="eleven-columns">\n\t\t<h3>Post Archives</h3>\n\t</div>\n' + \
-    '\t<div class="eleven-columns">\n\t\t<ul class="square">\n'
+  # Find every post file up front so we can tell which pages are already current.
+  files = {}
+  for year in post_years():
+    for month in post_months(year):
+      files[(year, month)] = [post_source(year, month, file) for file in 
+                              post_files(year, month)]
+  archives_sources = post_sources([path for month in files.values() for path in month])
+  archives_current = is_current('archives', archives_sources)
+  
+  # Start the body for the archives.htm page, it's gathered up in a list and joined at 
+  # the end.
+  archives_body = ['\t<div class="eleven-columns">\n\t\t<h3>Post Archives</h3>\n\t</div>\n' + \
+    '\t<div class="eleven-columns">\n\t\t<ul class="square">\n']
 
   # Grab all the years in the posts folder.
-  for year in sorted(os.listdir(posts_folder), reverse=True): 
-
-    # Ensure that we're working with a year folder.
-    if re.match('\d\d\d\d', year):
-      if args.verbose: print 'Building indexes for ' + year + ':'
-			
-      # Add an entry to archives.htm
-      archives_body += '\t\t\t<li><a href="/' + year + '">' + year + '</a>\n\t\
-        \t\t<ul class="circle">\n'
-
-      # Make a corresponding year folder in the build folder if it doesn't exist.
-      year_path = build_folder + '/' + year
-      if not os.path.exists(year_path): os.makedirs(year_path)
-      
-      # Open up a list to dump all the year's posts in.
-      year_catch = []
-
-      # Grab all the month folders for the current year.
-      for month in sorted(os.listdir(posts_folder + '/' + year), reverse=True):
-
-        # Ensure we're working with a year folder.
-        if re.match('\d\d', month):
-          if args.verbose: print "\t" + month
-
-          # Add an entry to archives.htm.
-          archives_body += '\t\t\t\t\t<li><a href="/' + year + '/' + month + '">' + month \
-              + '</a>\n'
-
-          # Make a corresponding month folder in the build folder if it doesn't exist.
-          month_path = build_folder + '/' + year + '/' + month
-          if not os.path.exists(month_path): os.makedirs(month_path)
-
-          # Open up a list to dump all the month's posts in.
-          month_catch = []
-
-          # Grab all the posts for the current month.
-          for i in os.listdir(posts_folder + '/' + year + '/' + month):
-
-            # Process the posts with the correct extension.
-            if i.endswith(conf['extension']):
-
-              # Create a new post object and parse the post file.
-              post = Post()
-              f = open(posts_folder + '/' + year + '/' + month + '/' + i)
-              post.filename = i
-              post.parse(f.read())        
-              f.close()
-
-              # Add this post to the list for the current month and year.
-              month_catch.append(post)
-              year_catch.append(post)
-          
-          # Once all the posts for the current month have been processed. make a new 
-          # Page object for the month.
-          month_page = Page()
-          month_page.title = 'Posts from ' + str(year) + '/' + str(month) + ' | ' + \
-                             month_page.title
-          month_body = ""
-
-          # Create the body of the month page with all the posts for the month 
-          # in reverse chronological order.
-          for post in sorted(month_catch, key=lambda post: post.time, reverse = True):
-            month_body += post.formatted()
-          month_page.body = month_body
-
-          # Write out the titles to the posts to archives.htm in ascending order.
-          archives_body += '\t\t\t\t\t\t<ul>\n'
-          for post in sorted(month_catch, key=lambda post: post.time, reverse=True):
-            archives_body += '\t\t\t\t\t\t\t<li><a href="' + post.url() + '">' + \
-              str(post.title) + '</a></li>\n'
-          archives_body += '\t\t\t\t\t\t</ul>\n\t\t\t\t\t</li>\n'
-
-          # Write out the month page into the build folder.
-          m = open(build_folder + '/' + year + '/' + month + '/index.htm', "w")
-          m.writelines(month_page.formatted())
-          m.close()
-          os.chmod(build_folder + '/' + year + '/' + month + '/index.htm', 0644)
+  for year in post_years(): 
+    if args.verbose: print 'Building indexes for ' + year + ':'
+		
+    # Add an entry to archives.htm
+    archives_body.append('\t\t\t<li><a href="/' + year + '">' + year + '</a>\n\t\
+        \t\t<ul class="circle">\n')
+
+    # Make a corresponding year folder in the build folder if it doesn't exist.
+    year_path = build_folder + '/' + year
+    if not os.path.exists(year_path): os.makedirs(year_path)
+    
+    # Open up a list to dump all the year's posts in.
+    year_catch = []
+    year_sources = post_sources([path for month in post_months(year) 
+                                 for path in files[(year, month)]])
+    year_current = is_current('year:' + year, year_sources)
+
+    # Grab all the month folders for the current year.
+    for month in post_months(year):
+      if args.verbose: print "\t" + month
+
+      # Add an entry to archives.htm.
+      archives_body.append('\t\t\t\t\t<li><a href="/' + year + '/' + month + '">' + \
+          month + '</a>\n')
+
+      # Make a corresponding month folder in the build folder if it doesn't exist.
+      month_path = build_folder + '/' + year + '/' + month
+      if not os.path.exists(month_path): os.makedirs(month_path)
+
+      # If no page that lists this month has changed there's nothing to do.
+      month_sources = post_sources(files[(year, month)])
+      month_current = is_current('month:' + year + '/' + month, month_sources)
+      if month_current and year_current and archives_current: continue
+
+      # Grab the month's posts from the catalog, they are already in reverse 
+      # chronological order.
+      month_catch = get_month(year, month)
+      year_catch.extend(month_catch)
       
-      # Close out the list of months in archive.htm
-      archives_body += '\t\t\t\t</ul>\n\t\t\t</li>\n'
+      # Write out the titles to the posts to archives.htm in ascending order.
+      archives_body.append('\t\t\t\t\t\t<ul>\n')
+      for post in month_catch:
+        archives_body.append('\t\t\t\t\t\t\t<li><a href="' + post.url() + '">' + \
+          str(post.title) + '</a></li>\n')
+      archives_body.append('\t\t\t\t\t\t</ul>\n\t\t\t\t\t</li>\n')
+
+      if month_current: continue
       
-      # Once all the posts for the current year have been processed, make a new
-      # Page object for the year.
-      year_page = Page()
-      year_page.title = 'Posts from ' + str(year) + ' | ' + year_page.title
-      year_body = ""
-
-      # Create the body of the year page with all the posts for the year in reverse 
-      # chronological order. 
-      for post in sorted(year_catch, key=lambda post: post.time, reverse = True):
-        year_body += post.formatted()
-      year_page.body = year_body
-
-      # Write out the year page to the build folder.
-      y = open(build_folder + '/' + year + '/index.htm', "w")
-      y.writelines(year_page.formatted())
-      y.close
-      os.chmod(build_folder + '/' + year + '/index.htm', 0644)
+      # Once all the posts for the current month have been processed, write out the 
+      # month's index pages into the build folder with all the posts for the month in 
+      # reverse chronological order.
+      filename = write_index(month_path, '/' + year + '/' + month + '/', 
+                             'Posts from ' + str(year) + '/' + str(month), month_catch)
+      record_target('month:' + year + '/' + month, filename, month_sources)
+    
+    # Close out the list of months in archive.htm
+    archives_body.append('\t\t\t\t</ul>\n\t\t\t</li>\n')
     
+    if year_current: continue
+    
+    # Once all the posts for the current year have been processed, write out the year's
+    # index pages to the build folder with all the posts for the year in reverse 
+    # chronological order.
+    filename = write_index(year_path, '/' + year + '/', 'Posts from ' + str(year), 
+                           sorted(year_catch, key=lambda post: post.time, reverse = True))
+    record_target('year:' + year, filename, year_sources)
+    
+  if archives_current: return
+  
   # Close out the list of years in archive.htm
-  archives_body += '\t\t</ul>\n\t</div>'
+  archives_body.append('\t\t</ul>\n\t</div>')
   
   archives_page = Page()
   archives_page.title = 'Archives | ' + archives_page.title
-  archives_page.body = archives_body
+  archives_page.body = ''.join(archives_body)
   
-  a = open(build_folder + '/archives.htm', 'w')
-  a.writelines(archives_page.formatted())
-  a.close
-  os.chmod(build_folder + '/archives.htm', 0644)
+  write_output(build_folder + '/archives.htm', archives_page.formatted())
+  record_target('archives', build_folder + '/archives.htm', archives_sources)
     
     
 # crunch_clean() deletes the build folder to clear out old ghosts.
@@ -769,9 +1869,187 @@ def crunch_clean():
   if os.path.exists(build_folder):
     shutil.rmtree(build_folder)
 
-# crunch_email(message) processes an email from a string (message) to create a new post.
+# crunch_clear_cache() deletes the markdown render cache, and the post fragments made from
+# it, so that everything gets rendered fresh.
+def crunch_clear_cache():
+  global index
+  if args.verbose: print 'Clearing the render cache.'
+  if os.path.exists(cache_folder + '/markdown'):
+    shutil.rmtree(cache_folder + '/markdown')
+  
+  if os.path.exists(index_file):
+    if index is None: index = open_index()
+    index.execute('delete from fragments')
+    index.commit()
+
+# read_email() reads an email message from a file and returns its headers, as a message 
+# with no body, and a list of (headers, file) for each part of it that isn't multipart. 
+# The body of each part is decoded into a temporary file as it's read, so only a line of 
+# the message is ever held in memory however big the attachments are.
+def read_email(f):
+  message = read_email_headers(f)
+  parts = []
+  read_email_body(f, message, None, parts)
+  return message, parts
+
+# read_email_headers() reads the header block of a message or part from a file and 
+# returns it as a message with no body.
+def read_email_headers(f):
+  lines = []
+  for line in iter(f.readline, ''):
+    if not line.rstrip('\r\n'): break
+    lines.append(line)
+  return email.parser.HeaderParser().parsestr(''.join(lines))
+
+# email_boundary() returns 'next' if line is the boundary before another part, 'last' if 
+# it's the boundary that closes the multipart, or None.
+def email_boundary(line, boundary):
+  if boundary is None or not line.startswith('--'): return None
+  line = line.rstrip()
+  if line == '--' + boundary: return 'next'
+  if line == '--' + boundary + '--': return 'last'
+  return None
+
+# read_email_body() reads the body of a message or part from a file, up to the boundary 
+# of the part it is in, adding each part that isn't multipart to parts. Returns the 
+# boundary line it stopped at, or '' at the end of the file.
+def read_email_body(f, message, boundary, parts):
+  # Read each part of a multipart, skipping anything before the first and after the 
+  # last, then carry on to the enclosing boundary.
+  if message.get_content_maintype() == 'multipart' and message.get_boundary():
+    inner = message.get_boundary()
+    line = ''
+    for line in iter(f.readline, ''):
+      if email_boundary(line, inner) or email_boundary(line, boundary): break
+    else:
+      line = ''
+    
+    while email_boundary(line, inner) == 'next':
+      line = read_email_body(f, read_email_headers(f), inner, parts)
+    
+    if email_boundary(line, inner) == 'last':
+      for line in iter(f.readline, ''):
+        if email_boundary(line, boundary): return line
+      return ''
+    return line
+  
+  # Decode the body into a temporary file, which stays in memory if it's small.
+  body = tempfile.SpooledTemporaryFile(1024 * 1024)
+  encoding = (message.get('content-transfer-encoding') or '').strip().lower()
+  pending = ['']
+  
+  def write(data):
+    if encoding == 'base64':
+      pending[0] += ''.join(data.split())
+      usable = len(pending[0]) / 4 * 4
+      body.write(binascii.a2b_base64(pending[0][:usable]))
+      pending[0] = pending[0][usable:]
+    elif encoding == 'quoted-printable':
+      body.write(quopri.decodestring(data))
+    else:
+      body.write(data)
+  
+  # The line break before a boundary belongs to the boundary, so each line is written 
+  # once the next one has been read and the last one loses its line break if a boundary
+  # comes after it.
+  previous = None
+  end = ''
+  for line in iter(f.readline, ''):
+    if email_boundary(line, boundary):
+      end = line
+      break
+    if previous is not None: write(previous)
+    previous = line
+  if previous is not None and end:
+    write(previous[:-2] if previous.endswith('\r\n') else previous[:-1])
+  elif previous is not None:
+    write(previous)
+  
+  body.seek(0)
+  parts.append((message, body))
+  return end
+
+# The EXIF orientations of a rotated photo and the transpose that puts each one upright.
+orientations = {3: Image.ROTATE_180, 6: Image.ROTATE_270, 8: Image.ROTATE_90} \
+               if imaging_available else {}
+
+# email_image() takes in an image file attached to an email and a uuid, saves the image 
+# upright as images/posts/<id>.jpg and, if it's bigger than image_width x image_height, 
+# a smaller copy as <id>_z.jpg. Each is encoded once and then synced into the build folder
+# (hardlinked or reflinked with sync_mode). The smaller copy is scaled down by the JPEG 
+# decoder before it's resampled and only turned upright once it's small. Returns True if 
+# a smaller copy was made.
+def email_image(f, id):
+  original = Image.open(f)
+  
+  # Check for a rotated image.
+  try:
+    exif = original._getexif() or {}
+  except:
+    exif = {}
+  transpose = orientations.get(exif.get(0x0112))
+  if transpose is not None and args.verbose: print 'Image is rotated, correcting.'
+  
+  # The size of the image once it's upright.
+  width, height = original.size
+  if transpose in (Image.ROTATE_90, Image.ROTATE_270): width, height = height, width
+  
+  # If the image extends beyond the image_width x image_height square we need a smaller 
+  # version. This should not upscale any smaller images.
+  size = None
+  if width > conf['image_width'] or height > conf['image_height']:
+    if args.verbose: print 'Image is larger than ' + str(conf['image_width']) + \
+      'x' + str(conf['image_height'])
+    aspect = float(width) / float(height)
+    
+    # If the image is wider than it is tall, calculate the height from image_width, if 
+    # it's taller calculate the width from image_height, if it's square use image_width.
+    if aspect > 1:
+      size = (conf['image_width'], int(conf['image_width'] / aspect))
+    elif aspect < 1:
+      size = (int(conf['image_height'] * aspect), conf['image_height'])
+    else:
+      size = (conf['image_width'], conf['image_width'])
+  
+  paths = [id + '.jpg']
+  
+  # Save the full size image first, so it's gone from memory before the next decode.
+  if args.verbose: print 'Saving image to ' + images_folder + '/posts'
+  if original.mode not in ('RGB', 'L'): original = original.convert('RGB')
+  if transpose is not None: original = original.transpose(transpose)
+  original.save(images_folder + '/posts/' + id + '.jpg')
+  os.chmod(images_folder + '/posts/' + id + '.jpg', 0644)
+  del original
+  
+  if size:
+    if args.verbose: print 'Saving resized image to ' + images_folder + '/posts'
+    
+    # Decode the image again at the smallest scale the decoder can manage that's still 
+    # bigger than the copy, resize it sideways if it's rotated and then turn it upright.
+    if transpose in (Image.ROTATE_90, Image.ROTATE_270): size = (size[1], size[0])
+    f.seek(0)
+    image = Image.open(f)
+    image.draft('RGB', size)
+    if image.mode not in ('RGB', 'L'): image = image.convert('RGB')
+    image = image.resize(size, Image.ANTIALIAS)
+    if transpose is not None: image = image.transpose(transpose)
+    image.save(images_folder + '/posts/' + id + '_z.jpg')
+    os.chmod(images_folder + '/posts/' + id + '_z.jpg', 0644)
+    paths.append(id + '_z.jpg')
+  
+  # If the build folder exists put the image(s) there as well.
+  if os.path.exists(build_folder):
+    if args.verbose: print 'Syncing images to ' + build_folder + '/images/posts/'
+    if not os.path.exists(build_folder + '/images/posts'): 
+      os.makedirs(build_folder + '/images/posts')
+    for path in paths:
+      sync_file(images_folder + '/posts/' + path, build_folder + '/images/posts/' + path)
+  
+  return size is not None
+
+# crunch_email() processes an email, as returned by read_email(), to create a new post.
 # it returns the filename of the post file that was created.
-def crunch_email(message):
+def crunch_email(message, parts):
   if args.verbose: print 'Crunching the email.'
 
   # Validate the email is OK to process based on the sender (easily spoofable).
@@ -791,8 +2069,7 @@ def crunch_email(message):
     if args.verbose: print 'Title: ', title
     
     # Process the post slug from the title, the slug is also the filename.
-    slug = re.sub('\-{2,}', '-', re.sub('[^a-z0-9-]', '', re.sub('\s', '-', re.sub('&', \
-                  'and', title.lower()))))
+    slug = make_slug(title)
     if args.verbose: print 'Slug:', slug
     
     # Making empty body to put stuff in.
@@ -801,13 +2078,20 @@ def crunch_email(message):
     # Walk through the message parts to find any plain/text body elements or 
     # image attachments.
     if args.verbose: print 'Running through the message parts.'
-    for part in message.walk():
+    for part, payload in parts:
       type = part.get_content_type()
     
-      # If the content is text/plain, use it for the message body. (This may accidentally
-      # collect certain types of forwarded messages.)
+      # If the content is text/plain, use it for the message body.
+      # Post files are UTF-8, so text in any other charset is converted.
       if type == 'text/plain':
-        body = body + part.get_payload()
+        text = payload.read()
+        charset = part.get_content_charset()
+        if charset and not charset in ('utf-8', 'us-ascii'):
+          try:
+            text = text.decode(charset, 'replace').encode('utf-8')
+          except LookupError:
+            if args.verbose: print 'WARN: Unknown charset ' + charset + ', left as is.'
+        body = body + text
     
       # If the content/type starts with 'image' process the image and add it to the top 
       # of the body.
@@ -829,88 +2113,8 @@ def crunch_email(message):
           while os.path.exists(images_folder + '/posts/' + id + '.jpg'):
             id = str(uuid.uuid4())
           
-          # Get the image blob from the email.
-          payload = part.get_payload(decode=True)
-
-          # Open the image with PIL.
-          original = Image.open(StringIO(payload))
-
-          # Check for a rotated image.
-          for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation]=='Orientation' : break
-          if original._getexif():
-            exif = dict(original._getexif().items())
-          else: 
-            exif = False 
-          
-          
-          
-          if not exif == False:
-            try:
-              if args.verbose: print 'Image is rotated, correcting.'
-              if exif[orientation] == 3:
-                original = original.rotate(180, expand=True)
-              elif exif[orientation] == 6:
-                original = original.rotate(270, expand=True)
-              elif exif[orientation] == 8:
-                original = original.rotate(90, expand=True)
-            except:
-              if args.verbose: print 'Cannot detect rotation from EXIF.'
-              
-
-          # Create empty resized var.
-          resized = False
-
-          # If the image extends beyond the image_width x image_height square we
-          # need to resize the image and save a smaller version.
-          # This should not upscale any smaller images.
-          if original.size[0] > conf['image_width'] or original.size[1] > \
-            conf['image_height']:
-            if args.verbose: print 'Image is larger than ' + str(conf['image_width']) + \
-              'x' + str(conf['image_height'])
-            # Calculate the aspect ratio of the image.
-            aspect = float(original.size[0])/float(original.size[1])
-
-            # If the image is wider than it is tall, calculate the height from 
-            # image_width.
-            if aspect > 1:
-              resized = original.resize((conf['image_width'],int(conf['image_width'] / \
-                aspect)), Image.ANTIALIAS)
-
-            # If the image is taller than it is wider, calculate the width from 
-            # image_height.
-            elif aspect < 1:
-              resized = original.resize((int(conf['image_height']*aspect), \
-                conf['image_height']), Image.ANTIALIAS)
-
-            # If the image is square use image_width to set the size.
-            else:
-              resized = original.resize((conf['image_width'], conf['image_width']), \
-                Image.ANTIALIAS)
-          
-          if args.verbose: print 'Saving image to ' + images_folder + '/posts'
-          
-          # Save the original file to the $images/posts folder.
-          original.save(images_folder + '/posts/' + id + '.jpg')
-          os.chmod(images_folder + '/posts/' + id + '.jpg', 0644)
-
-          # If we created a resized copy, save to the $images/posts folder.
-          if not resized == False:
-            if args.verbose: print 'Saving resized image to ' + images_folder + '/posts'
-            resized.save(images_folder + '/posts/' + id + '_z.jpg')
-            os.chmod(images_folder + '/posts/' + id + '_z.jpg', 0644)
-          
-          # If the build folder exists save the image(s) to there as well.
-          if os.path.exists(build_folder):
-            if args.verbose: print 'Saving image to ' + build_folder + '/images/posts/'
-            original.save(build_folder + '/images/posts/' + id + '.jpg')
-            os.chmod(build_folder + '/images/posts/' + id + '.jpg', 0644)
-            
-            if not resized == False:
-              if args.verbose: print 'Saving resized image to ' + build_folder + \
-                '/images/posts/'
-              resized.save(build_folder + '/images/posts/' + id + '_z.jpg')
-              os.chmod(build_folder + '/images/posts/' + id + '_z.jpg', 0644)
+          # Save the image and a smaller copy if it needs one.
+          resized = email_image(payload, id)
           
           # Generate an image tag string based on whether we had to resize the image or 
           # not.
@@ -937,9 +2141,7 @@ def crunch_email(message):
     short = None
     if args.http:
       if args.verbose: print 'Getting short url.'
-      short = urllib2.urlopen('http://amd.im/api-create/' + conf['base_url'] + \
-                              time.strftime('%Y', email_date) + '/' + time.strftime('%Y',\
-                              email_date) + '/' + slug).read().lstrip('http://amd.im/')
+      short = get_short(post_link(email_date, slug))
     else:
       if args.verbose: print 'WARN: HTTP calls disabled, short url unavailable.'
           
@@ -969,24 +2171,20 @@ def crunch_email(message):
       f.write('short: ' + short + '\n')
     f.write('\n')
     f.write(body)
-    f.close
+    f.close()
     os.chmod(filename, 0644)
     
+    # Clear out the temporary files.
+    for part, payload in parts:
+      payload.close()
+    
     # Return the filename.
     return filename
 
 
-# crunch_single() generates a new post file from an inputted string and returns the post 
-# object. Is used for both generating from a post file, from stdin, or from a parsed 
-# email.
-def crunch_single(string): 
-  # Create a new Post object for this new post.
-  post = Post()
-  if args.verbose: print 'Parsing post.'
-
-  # Parse the incoming string into the post object.
-  post.parse(string)
-
+# write_post() takes in a parsed post object, writes out its page to the build folder and 
+# returns the filename. Used by crunch_single() and crunch_posts().
+def write_post(post):
   # Create a new page.
   if args.verbose: print 'Creating new page.'
   page = Page()
@@ -1014,105 +2212,113 @@ def crunch_single(string):
 
   
   # Write out the page to the new file.
-  n = open(filename, "w")
-  n.writelines(page.formatted())
-  n.close
-  os.chmod(filename, 0644)
-
-  # If the dependencies flag is set, we need to rebuild the pages that would include
-  # this post.
-  if args.dependencies:
-    
-    # Let's rebuild the index pages for this post's year and month.
-    if args.verbose: print 'Rebuilding indexes for ' + post.year() + '/' + post.month() \
-      + ':'
+  wall, cpu = time.time(), time.clock()
+  write_output(filename, page.formatted())
+  profile_step('write', os.path.relpath(filename, base_folder), wall, cpu)
+  
+  return filename
+
+# crunch_dependencies() takes in a list of new posts and rebuilds the pages that include
+# them, the indexes for their months and years, the home page and the feed. Each page is
+# only rebuilt once, however many of the posts are on it.
+def crunch_dependencies(posts):
+  months = set((post.year(), post.month()) for post in posts)
+  years = set(year for year, month in months)
+  
+  # The catalog and post index don't know about these posts yet, so go back to the posts
+  # folder for their years. Everything else on the pages comes out of the post index, 
+  # with the formatted posts from their cached fragments.
+  refresh_years(years)
+  
+  for year in sorted(years):
+    # Let's rebuild the index pages for this year and the new posts' months.
+    if args.verbose: print 'Rebuilding indexes for ' + year + ':'
     
     # Make the year folder if it doesn't exist. (First post of a new year.)
-    year_path = build_folder + '/' + post.year()
+    year_path = build_folder + '/' + year
     if not os.path.exists(year_path): os.makedirs(year_path)
 
     # Open up a new list to dump all the years' posts.
     year_catch = []
 
     # Iterate through all the months for that year.
-    for month in os.listdir(year_path):
-      
-      # Make sure the folder's filename looks like a two digit month.
-      if re.match('\d\d', month):
+    for month in post_months(year):
+
+      # Create the current month's folder if it doesn't exist.
+      month_path = build_folder + '/' + year + '/' + month
+      if not os.path.exists(month_path): os.makedirs(month_path)
+
+      # Add it to the year list, and write out the index pages for the month with all 
+      # its posts sorted reverse chronologically if it has a new post.
+      month_catch = get_month(year, month)
+      year_catch.extend(month_catch)
+      if (year, month) in months:
+        if args.verbose: print '\t' + month
+        write_index(month_path, '/' + year + '/' + month + '/', 
+                    'Posts from ' + str(year) + '/' + str(month), month_catch)
+    
+    # Write out the index pages for the year with all the posts for that year sorted 
+    # reverse chronologically.
+    write_index(year_path, '/' + year + '/', 'Posts from ' + str(year), 
+                sorted(year_catch, key=lambda p: p.time, reverse = True))
+  
+  # Use crunch_home to rebuild the home page just to be sure that the new posts haven't
+  # affected it.
+  if args.verbose: print 'Rebuilding the home page.'    
+  crunch_home()
+  
+  # Rebuild the feed, just in case.
+  if args.verbose: print 'Rebuilding the feed.'
+  crunch_feed()
+
+# crunch_import() reads every message in a mailbox, oldest first, and makes a post out 
+# of each one just like --email does, without the confirmation emails. The pages that 
+# include the new posts are rebuilt once at the end. Takes in a mailbox.Mailbox.
+def crunch_import(box):
+  if args.verbose: print 'Importing ' + str(len(box)) + ' messages.'
+  
+  # Open each message once to find its date, so they go in the order they were sent.
+  dated = []
+  for key in box.iterkeys():
+    f = box.get_file(key)
+    date = parsedate_tz(read_email_headers(f).get('date') or '')
+    f.close()
+    dated.append((date and mktime_tz(date) or 0, key))
+  
+  posts = []
+  for date, key in sorted(dated):
+    f = box.get_file(key)
+    filename = crunch_email(*read_email(f))
+    f.close()
+    
+    if filename is None:
+      print 'WARN: Skipped message ' + str(key) + ', it is not from the email_sender.'
+      continue
+    
+    posts.append(crunch_single(open(filename).read(), False))
+  
+  if posts: crunch_dependencies(posts)
+  if args.verbose: print 'Imported ' + str(len(posts)) + ' posts.'
 
-        # Create the current month's folder if it doesn't exist.
-        month_path = build_folder + '/' + post.year() + '/' + month
-        if not os.path.exists(month_path): os.makedirs(month_path)
+# crunch_single() generates a new post file from an inputted string and returns the post 
+# object. Is used for both generating from a post file, from stdin, or from a parsed 
+# email. Pass dependencies=False to leave rebuilding the pages that include it to the 
+# caller.
+def crunch_single(string, dependencies=True): 
+  # Create a new Post object for this new post.
+  post = Post()
+  if args.verbose: print 'Parsing post.'
 
-        # Create a list to dump all the current month's posts in.
-        month_catch = []
+  # Parse the incoming string into the post object.
+  post.parse(string)
 
-        # Iterate through all the posts for the current month.
-        for i in os.listdir(posts_folder + '/' + post.year() + '/' + month):
-          
-          # Only process files that end with the correct extension.
-          if i.endswith(conf['extension']):
-            
-            # Create a new post object.
-            p = Post()
+  # Write out the post's page.
+  write_post(post)
 
-            # Open the post file.
-            f = open(posts_folder + '/' + post.year() + '/' + month + '/' + i)
-            
-            # Parse the post.
-            p.filename = i
-            p.parse(f.read())
-            
-            # Close the post file.        
-            f.close()
-
-            # Add it to the year list. Add it to the month list, IF it is the 
-            # correct month for the new post we created. 
-            if month == post.month():
-              month_catch.append(p)
-            year_catch.append(p)
-    
-    # Create a new page for the month.    
-    month_page = Page()
-    month_page.title = 'Posts from ' + str(post.year()) + '/' + str(post.month()) + ' | '\
-                       + month_page.title
-    month_body = ""
-
-    # Insert all the posts for that month into the body sorted reverse chronologically.
-    for p in sorted(month_catch, key=lambda p: p.time, reverse = True):
-      month_body += p.formatted()
-    month_page.body = month_body
-
-    # Write out the index page for the post's month.
-    m = open(build_folder + '/' + post.year() + '/' + post.month() + '/index.htm', "w")
-    m.writelines(month_page.formatted())
-    m.close()
-    os.chmod(build_folder + '/' + post.year() + '/' + post.month() + '/index.htm', 0644)
-    
-    # Create a new page for the post's year.
-    year_page = Page()
-    year_page.title = 'Posts from ' + str(post.year()) + ' | ' + year_page.title
-    year_body = ""
-
-    # Insert all the posts for that year into the body sorted reverse chronologically.
-    for p in sorted(year_catch, key=lambda p: p.time, reverse = True):
-      year_body += p.formatted()
-    year_page.body = year_body
-
-    # Write out the index page for the post's year.
-    y = open(build_folder + '/' + post.year() + '/index.htm', "w")
-    y.writelines(year_page.formatted())
-    y.close
-    os.chmod(build_folder + '/' + post.year() + '/index.htm', 0644)
-    
-    # Use crunch_home to rebuild the home page just to be sure that the new post 
-    # hasn't affected it.
-    if args.verbose: print 'Rebuilding the home page.'    
-    crunch_home()
-    
-    # Rebuild the feed, just in case.
-    if args.verbose: print 'Rebuilding the feed.'
-    crunch_feed()
+  # If the dependencies flag is set, we need to rebuild the pages that would include
+  # this post.
+  if dependencies and args.dependencies:
+    crunch_dependencies([post])
 
   return post
 
@@ -1131,46 +2337,157 @@ def confirmation_email(post):
   p.write("From: " + conf['email_receiver'] + '\n')
   p.write('To: ' + conf['email_sender'] + '\n')
   p.write('Subject: Created "' + post.title + '"\n')
+  p.write('MIME-Version: 1.0\n')
+  p.write('Content-Type: text/plain; charset=utf-8\n')
   p.write('\n')
-  p.write('"' + post.title + '" created.\n' + 
-          'pretty_date: "' + post.date_pretty() + '"\n' +
-          'slug: "' + post.slug + '"\n' +
-          'filename: "' + post.filename + '"\n' + 
-          'body: \n\n' + post.content)
+  
+  # The rendered post is unicode once it has anything but ASCII in it.
+  text = '"' + post.title + '" created.\n' + \
+         'pretty_date: "' + post.date_pretty() + '"\n' + \
+         'slug: "' + post.slug + '"\n' + \
+         'filename: "' + post.filename + '"\n' + \
+         'body: \n\n' + post.content
+  if isinstance(text, unicode): text = text.encode('utf-8')
+  p.write(text)
   
   # Close p and send the email
-  p.close
+  p.close()
     
 
 # crunch_feed() will generate an rss feed for the site.
 def crunch_feed():
   if args.verbose: print 'Crunch RSS feed.'
 
+  # Skip the feed if none of the posts in it have changed.
+  sources = post_sources(recent_sources(conf['feed_count']))
+  if is_current('feed', sources):
+    if args.verbose: print '\tFeed is current.'
+    return
+
   # Get recent posts.  
   if args.verbose: print '\tGet all the required posts.'
   post_list = get_recent(conf['feed_count'])
                   
   if args.verbose: print '\tGenerating the new feed.'
 
-  # Make an empty body variable
-  body = ''
-   
-  # Add all the xml formatted posts to the body.
-  for post in post_list:
-    body += post.xml()
-
-  # Make a new page object.
+  # Make a new page object with a marker for the body, so we can split the feed around it.
   page = Page()
-  
-  # Add in the new body.
-  page.body = body
+  page.body = '\0items\0'
+  head, tail = page.xml().split('\0items\0')
 
-  # Write out the post to the new file.
+  # Write out the feed to the new file, streaming the xml formatted posts into the body.
   if args.verbose: print '\tWriting out the feed.'
-  f = open(build_folder + '/index.xml' , 'w')
-  f.writelines(page.xml())
-  f.close
-  os.chmod(build_folder + '/index.xml', 0644)  
+  f = Output_File(build_folder + '/index.xml')
+  f.write(head)
+  for post in post_list:
+    f.write(post_fragment(post, 'xml'))
+  f.write(tail)
+  f.close()
+  record_target('feed', build_folder + '/index.xml', sources)
+
+# Derivatives that couldn't be made, so they are only tried once per run (or per rebuild
+# with --watch).
+derivative_failures = set()
+
+# gallery_derivatives() makes sure the build folder has a folder for the named gallery and
+# returns a (master, derivative, size) task for every thumbnail or mid size image in it 
+# that is missing or older than its master image.
+def gallery_derivatives(name):
+  source = galleries_folder + '/' + name
+  destination = build_folder + '/' + conf['galleries_folder'] + '/' + name
+  
+  # Make a destination gallery.
+  if not os.path.exists(destination):
+    os.makedirs(destination)
+    os.chmod(destination, 0755)
+  
+  # Let's make sure that we have the necessary libraries for image processing.
+  if not imaging_available:
+    if args.verbose: print 'WARN: PIL not available, not making gallery images.'
+    return []
+  
+  tasks = []
+  for file in sorted(os.listdir(source)):
+    if filter(file.endswith, image_extensions) and not re.search('_z', file) and \
+      not re.search('_thm', file):
+      i = Gallery_Image()
+      i.master_image = file
+      i.gallery_name = name
+      
+      # Thumbnails fit in thumbnail_width x thumbnail_height (200x200 by default), mid size
+      # images in image_width x image_height.
+      for derivative, size in [(i.thumbnail_file(), (conf.get('thumbnail_width', 200), 
+                                                     conf.get('thumbnail_height', 200))),
+                               (i.mid_file(), (conf['image_width'], 
+                                               conf['image_height']))]:
+        # Derivatives made by hand in the gallery folder take precedence.
+        if os.path.exists(source + '/' + derivative): continue
+        if not os.path.exists(destination + '/' + derivative) or \
+          os.path.getmtime(destination + '/' + derivative) < \
+          os.path.getmtime(source + '/' + file):
+          if destination + '/' + derivative in derivative_failures: continue
+          tasks.append((source + '/' + file, destination + '/' + derivative, size))
+  
+  return tasks
+
+# make_derivative() takes in a (master, derivative, size) task and saves a copy of the 
+# master image scaled down to fit within size. It returns None, or the traceback if it 
+# failed, so that it can be run in a worker process.
+def make_derivative(task):
+  master, derivative, size = task
+  wall, cpu = time.time(), time.clock()
+  try:
+    image = Image.open(master)
+    format = image.format
+    
+    # Let the JPEG decoder do most of the scaling, then finish it off properly. This 
+    # never upscales a smaller image.
+    image.draft('RGB', size)
+    image.thumbnail(size, Image.ANTIALIAS)
+    if format == 'JPEG' and image.mode != 'RGB':
+      image = image.convert('RGB')
+    
+    # Save through a temporary file so a half written image is never served.
+    tmp = derivative + '.' + str(os.getpid()) + '.tmp'
+    image.save(tmp, format, quality=conf.get('image_quality', 85))
+    os.chmod(tmp, 0644)
+    os.rename(tmp, derivative)
+  except:
+    return traceback.format_exc()
+  finally:
+    profile_step('image', os.path.relpath(derivative, base_folder), wall, cpu)
+
+# derivative_job() runs make_derivative() in a worker process and returns its error along
+# with the steps it profiled.
+def derivative_job(task):
+  take_steps()
+  error = make_derivative(task)
+  return error, take_steps()
+
+# crunch_derivatives() makes every derivative in a list of tasks, spread across a pool of
+# processes if --jobs asks for one.
+def crunch_derivatives(tasks):
+  if not tasks: return
+  if args.verbose: print 'Making ' + str(len(tasks)) + ' gallery images.'
+  
+  if args.jobs > 1 and len(tasks) > 1:
+    pool = multiprocessing.Pool(args.jobs)
+    results = pool.map(derivative_job, tasks)
+    pool.close()
+    pool.join()
+    
+    errors = [error for error, steps in results]
+    for error, steps in results:
+      if steps: profile['steps'].extend(steps)
+  else:
+    errors = map(make_derivative, tasks)
+  
+  # A broken image shouldn't stop the rest of the build.
+  for (master, derivative, size), error in zip(tasks, errors):
+    if error:
+      derivative_failures.add(derivative)
+      print 'ERROR: Could not make ' + os.path.basename(derivative) + ' from ' + master
+      if args.verbose: print error
 
 # Create a specific gallery matching a string identifier.
 def crunch_gallery(name):
@@ -1180,18 +2497,15 @@ def crunch_gallery(name):
     print 'ERROR: Gallery ' + name + ' does not exist.'
     return 1
 
-  # Define some allowable image extensions.
-  image_extensions = ('.jpg', '.jpeg', '.gif', '.png')
+  # Make a destination gallery and any thumbnails and mid size images that are missing.
+  crunch_derivatives(gallery_derivatives(name))
 
-  # Make a destination gallery.
-  if not os.path.exists(build_folder + '/' + conf['galleries_folder'] + '/' + name):
-    os.mkdir(build_folder + '/' + conf['galleries_folder'] + '/' + name)
-    os.chmod(build_folder + '/' + conf['galleries_folder'] + '/' + name, 0755)
-
-  images = ''
+  images = []
+  files = []
   
-  # Run through the files in the directory.
-  for file in os.listdir(galleries_folder + '/' + name):
+  # Run through the files in the directory, in order so the gallery page doesn't change
+  # from one build to the next.
+  for file in sorted(os.listdir(galleries_folder + '/' + name)):
 
     # Process the meta data file.
     if file == 'meta.yaml':
@@ -1204,15 +2518,13 @@ def crunch_gallery(name):
       
       try:
         description = '<div class="eleven columns">' + \
-          markdown2.markdown(str(a[1]), extras=["code-color", "code-friendly"])  
+          render_markdown(str(a[1]))
       except:
         description = '<div class="eleven columns">'
   
-    # Copy all the images.
+    # Collect all the images to copy.
     if filter(file.endswith, image_extensions):
-      if args.verbose: print '\tCopying image ' + file
-      shutil.copy(galleries_folder + '/' + name + '/' + file, 
-                  build_folder + '/'+ conf['galleries_folder'] + '/' + name + '/' + file)
+      files.append(file)
     
       if not re.search('_z', file) and not re.search('_thm', file):
         i = Gallery_Image()
@@ -1221,18 +2533,26 @@ def crunch_gallery(name):
         
         p = Page()
       
-        images += i.formatted_thumb()
+        images.append(i.formatted_thumb())
         p.body = i.formatted_single()
         
-        f = open(build_folder + '/' + conf['galleries_folder'] + '/' + name + '/' + \
-          i.name() + '.htm', 'w')
-        f.writelines(p.formatted())
-        f.close
-        os.chmod(build_folder + '/' + conf['galleries_folder'] + '/' + name + '/' + \
-          i.name() + '.htm', 0644)
+        write_output(build_folder + '/' + conf['galleries_folder'] + '/' + name + '/' + \
+          i.name() + '.htm', p.formatted())
    
    
-  images += "</div>"
+  images.append("</div>")
+  
+  # Copy the images that have changed and clear out the ones that are gone, along with 
+  # their thumbnails, mid size images and pages.
+  destination = build_folder + '/' + conf['galleries_folder'] + '/' + name
+  for file in sync_files(galleries_folder + '/' + name, destination, files, 
+                         'gallery:' + name):
+    i = Gallery_Image()
+    i.master_image = file
+    i.gallery_name = name
+    for generated in [i.thumbnail_file(), i.mid_file(), i.name() + '.htm']:
+      if os.path.exists(destination + '/' + generated) and not generated in files:
+        os.remove(destination + '/' + generated)
    
   gal_page = Page()
   
@@ -1241,15 +2561,12 @@ def crunch_gallery(name):
     time.strftime("posted on %Y-%m-%d at %I:%M %p", \
     time.localtime(float(y['date']))) + '</p></div>'
   
-  gal_page.body = leader + description + images
+  gal_page.body = leader + description + ''.join(images)
   
   gal_page.title = str(y['title']) + ' | ' + gal_page.title
   
-  f = open(build_folder + '/' + conf['galleries_folder'] + '/' + name + '/index.htm', 'w')
-  f.writelines(gal_page.formatted())
-  f.close
-  os.chmod(build_folder + '/' + conf['galleries_folder'] + '/' + name + \
-    '/index.htm', 0644)
+  write_output(build_folder + '/' + conf['galleries_folder'] + '/' + name + '/index.htm', 
+               gal_page.formatted())
   
   
   
@@ -1257,109 +2574,331 @@ def crunch_gallery(name):
 def crunch_gallery_all():
   if args.verbose: print 'Building all galleries.'
   
-  for dir in [x[0] for x in os.walk(galleries_folder)]:
-    if not re.search(conf['galleries_folder'] + '$', dir):
-      crunch_gallery(os.path.basename(dir))
-
-      
-      
-      
-# Combine and minify CSS and JS.
+  names = [os.path.basename(x[0]) for x in os.walk(galleries_folder) 
+           if not re.search(conf['galleries_folder'] + '$', x[0])]
+  
+  # Make the thumbnails and mid size images for every gallery in one go, so they can all
+  # share the worker processes.
+  crunch_derivatives([task for name in names for task in gallery_derivatives(name)])
+  
+  for name in names:
+    crunch_gallery(name)
+
+# The filenames of the stylesheet and script bundles for this run, see bundle_url().
+bundles = {}
+
+# bundle_sources() takes in a kind of bundle, 'css' or 'js', and returns the files that 
+# go into it in the order they go in. Files starting with an underscore are left out.
+def bundle_sources(kind):
+  folder = kind == 'css' and css_folder or scripts_folder
+  return [folder + '/' + file for file in sorted(os.listdir(folder)) 
+          if file.endswith('.' + kind) and not file.startswith('_')]
+
+# bundle_url() takes in a kind of bundle, 'css' or 'js', and returns the url of the 
+# bundle the manifest has, even if its sources have changed since, so that every page 
+# links to the same one. Only crunch_extras() replaces it. The bundle is only built here 
+# if there isn't one yet.
+def bundle_url(kind):
+  folder = conf[kind == 'css' and 'css_folder' or 'scripts_folder']
+  if not kind in bundles:
+    entry = get_manifest()['targets'].get('bundle:' + kind)
+    if entry and os.path.exists(base_folder + '/' + entry['output']):
+      bundles[kind] = os.path.basename(entry['output'])
+    else:
+      bundles[kind] = crunch_bundle(kind, bundle_sources(kind))
+  return '/' + folder + '/' + bundles[kind]
+
+# crunch_bundle() takes in a kind of bundle and its sources, minifies and combines them 
+# into the build folder and returns the bundle's filename. The name has a hash of the 
+# content in it, so a bundle never changes once it's written and can be cached for good.
+# The bundle it replaces is noted in the manifest for prune_bundles().
+def crunch_bundle(kind, sources):
+  if args.verbose: 
+    print 'Bundling the ' + (kind == 'css' and 'stylesheets' or 'scripts') + '.'
+  minify = kind == 'css' and minify_css or minify_js
+  
+  parts = []
+  for source in sources:
+    text = open(source).read()
+    
+    # If the file is minified already, we still want it but don't want to waste time.
+    if source.endswith('.min.' + kind):
+      parts.append(text)
+    else:
+      parts.append(minify(text))
+  
+  # Scripts each get a line of their own, in case one doesn't end in a semicolon.
+  data = (kind == 'js' and '\n' or '').join(parts)
+  
+  folder = build_folder + '/' + conf[kind == 'css' and 'css_folder' or 'scripts_folder']
+  name = 'app.' + hashlib.sha1(data).hexdigest()[:6] + '.' + kind
+  if not os.path.exists(folder): os.makedirs(folder)
+  write_output(folder + '/' + name, data)
+  
+  # Work out which bundle this one replaces, unless it came out the same as before.
+  entry = get_manifest()['targets'].get('bundle:' + kind, {})
+  previous = entry.get('output') and os.path.basename(entry['output'])
+  if previous == name:
+    previous = entry.get('previous')
+  record_target('bundle:' + kind, folder + '/' + name, sources + ['minifier'], 
+                previous=previous)
+  if args.verbose: print '\t' + name
+  return name
+
+# crunch_extras() copies over the stylesheets and scripts starting with an underscore as 
+# they are and brings the bundles of the rest up to date. Returns True if either bundle 
+# changed, in which case every page needs building again to link to it.
 def crunch_extras():
   if args.verbose: print 'Combining and minifying stylesheets and scripts.'
   
-  # Make some empty variables to put the minified content in.
-  css_min = []
-  js_min = []
+  # Copy excluded files straight over with no changes.
+  for folder, key in [(css_folder, 'css_folder'), (scripts_folder, 'scripts_folder')]:
+    for file in sorted(os.listdir(folder)):
+      if file.startswith('_'):
+        sync_file(folder + '/' + file, build_folder + '/' + conf[key] + '/' + 
+                  file.lstrip('_'))
   
-  # Iterate through the css files.
-  for file in sorted(os.listdir(css_folder)):
+  # Check the bundles against their sources again.
+  old = [bundle_url(kind) for kind in 'css', 'js']
+  for kind in 'css', 'js':
+    sources = bundle_sources(kind)
+    if not is_built('bundle:' + kind, sources + ['minifier']):
+      bundles[kind] = crunch_bundle(kind, sources)
+  return old != [bundle_url(kind) for kind in 'css', 'js']
+
+# prune_bundles() removes the bundles older than the current one and the one it replaced,
+# along with their gzipped copies. The one before is kept for browsers and caches still 
+# holding pages that link to it. Only call it once every page links to the current one.
+def prune_bundles():
+  for kind in 'css', 'js':
+    entry = get_manifest()['targets'].get('bundle:' + kind)
+    if entry is None: continue
     
-    # Ignore excluded files. 
-    if not file.startswith('_'):
+    folder = build_folder + '/' + conf[kind == 'css' and 'css_folder' or 'scripts_folder']
+    keep = (os.path.basename(entry['output']), entry.get('previous'))
+    for file in sorted(os.listdir(folder)):
+      match = re.match('(app\.[0-9a-f]{6}\.' + kind + ')(\.gz)?$', file)
+      if match and not match.group(1) in keep:
+        if args.verbose: print 'Removing the old bundle ' + file
+        os.remove(folder + '/' + file)
+
+# The build outputs that get a gzipped copy with --gzip.
+gzip_extensions = ('.htm', '.html', '.xml', '.css', '.js', '.txt', '.svg', '.json')
+
+# gzip_current() returns True if path has a gzipped copy that was made from it as it is 
+# now. The copy is given the same mtime as the file it was made from, give or take the 
+# microsecond os.utime() rounds it to.
+def gzip_current(path):
+  try:
+    return abs(os.stat(path + '.gz').st_mtime - os.stat(path).st_mtime) < 0.00001
+  except OSError:
+    return False
+
+# crunch_gzip() writes a gzipped copy next to every text file in the build folder that 
+# has changed since it was last compressed, and removes copies whose file is gone. Only 
+# .gz files named after one of gzip_extensions count as copies, anything else is left 
+# alone. The copies leave out the name and time so the same file always compresses the 
+# same way.
+def crunch_gzip():
+  if args.verbose: print 'Compressing the build folder.'
+  
+  compressed = removed = 0
+  for root, dirs, files in os.walk(build_folder):
+    for name in files:
+      path = os.path.join(root, name)
       
-      # Only Process all the non-minified CSS files.
-      if file.endswith('.css') and not file.endswith('.min.css'):
+      if name.endswith('.gz'):
+        if path[:-3].endswith(gzip_extensions) and not os.path.exists(path[:-3]):
+          os.remove(path)
+          removed += 1
+        continue
       
-        # Read the file into a tmp var.
-        tmp = open(css_folder + '/' + file).read()
-        
-        # Kill all the comments.
-        tmp = re.sub( r'/\*[\s\S]*?\*/', '', tmp)
-        
-        # Minimize the whitespace.
-        tmp = ' '.join(tmp.split())
-        
-        # Add it to the new file.
-        css_min.append(tmp)
+      if not name.endswith(gzip_extensions) or gzip_current(path): continue
       
-      # If the file is minified, we still want it but don't want to waste time.
-      if file.endswith('.min.css'):
-        css_min.append(open(css_folder + '/' + file).read())
+      data = StringIO()
+      f = gzip.GzipFile('', 'wb', 9, data, 0)
+      source = open(path, 'rb')
+      shutil.copyfileobj(source, f)
+      source.close()
+      f.close()
       
-    # If the file is excluded just copy it over.
-    if file.startswith('_'):
-      shutil.copy2(css_folder + '/' + file, build_folder + '/' + \
-        conf['css_folder'] + '/' + file.lstrip('_'))      
-  
-  # Write out our new minified CSS file.
-  f = open(build_folder + '/' + conf['css_folder'] + '/app.css', 'w')
-  f.writelines(''.join(css_min))
-  f.close
-  os.chmod(build_folder + '/' + conf['css_folder'] + '/app.css', 0644)      
+      replace_file(path + '.gz', data.getvalue())
+      st = os.stat(path)
+      os.utime(path + '.gz', (st.st_atime, st.st_mtime))
+      compressed += 1
+  
+  if args.verbose: 
+    print 'Compressed ' + str(compressed) + ' files, removed ' + str(removed) + '.'
+
+# The folders --watch keeps an eye on.
+watch_folders = [posts_folder, pages_folder, galleries_folder, css_folder, scripts_folder]
+
+# watch_snapshot() returns the mtime and size of every file in the watched folders and of
+# the configuration file, keyed by path.
+def watch_snapshot():
+  snapshot = {}
+  for folder in watch_folders:
+    for root, dirs, files in os.walk(folder):
+      for name in files:
+        try:
+          st = os.stat(os.path.join(root, name))
+        except OSError:
+          continue
+        snapshot[os.path.join(root, name)] = (st.st_mtime, st.st_size)
+  if os.path.exists(conf_file):
+    st = os.stat(conf_file)
+    snapshot[conf_file] = (st.st_mtime, st.st_size)
+  return snapshot
+
+# watch_changes() is a generator that yields the set of paths that changed each time the 
+# watched folders settle down after a change. Uses inotify where it's available and falls
+# back to polling every watch_interval seconds. Changes are gathered up until nothing has 
+# changed for watch_delay seconds, so saving a bunch of files only causes one rebuild.
+def watch_changes():
+  delay = conf.get('watch_delay', 0.5)
+  
+  if inotify_available:
+    changed = set()
+    
+    class handler(pyinotify.ProcessEvent):
+      def process_default(self, event):
+        changed.add(event.pathname)
+    
+    manager = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(manager, handler())
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+           pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+    for folder in watch_folders:
+      if os.path.exists(folder): manager.add_watch(folder, mask, rec=True, auto_add=True)
+    
+    # The configuration file is watched through its folder, since editors tend to replace
+    # it rather than write to it.
+    manager.add_watch(os.path.dirname(conf_file), mask)
+    
+    while True:
+      # Wait for something to happen, then keep reading until it's quiet again.
+      notifier.check_events(None)
+      notifier.read_events()
+      notifier.process_events()
+      while notifier.check_events(delay * 1000):
+        notifier.read_events()
+        notifier.process_events()
       
-  # Iterate through JS files.
-  for file in sorted(os.listdir(scripts_folder)):
+      paths = set(path for path in changed if path == conf_file or 
+                  any(path.startswith(folder + '/') for folder in watch_folders))
+      changed.clear()
+      if paths: yield paths
   
-    # Ignore excluded files.
-    if not file.startswith('_'):
+  else:
+    interval = conf.get('watch_interval', 1)
+    before = watch_snapshot()
+    
+    while True:
+      time.sleep(interval)
+      after = watch_snapshot()
+      if after == before: continue
       
-      # Only bother with JS files and ignore pre-minified ones.
-      if file.endswith('.js') and not file.endswith('.min.js'):
-        # Read the file into a tmp var.
-        for line in open(scripts_folder + '/' + file).readlines():
+      # Keep looking until it's quiet again.
+      while True:
+        time.sleep(delay)
+        latest = watch_snapshot()
+        if latest == after: break
+        after = latest
       
-          # Ignore comments lines.
-          if not re.match('//', line) and not re.match('\s+//', line):
-              
-              # minimize whitespace
-              line = ' '.join(line.split())          
-              
-              # add the minimized js to the new file
-              js_min.append(line)
-
-        # Kill all the comments.
-        #tmp = re.sub( r'\/\*.+?\*\/|\/\/.*(?=[\n\r])', "", tmp)
-        
-        # Minimize the whitespace. Can't eliminate as some is critical.
-        # Cannot be used unless comments are removed.
-        #tmp = re.sub(r'\s+', ' ', tmp)
-              
-        #js_min.append(tmp)
+      yield set(path for path in set(before) | set(after) 
+                if before.get(path) != after.get(path))
+      before = after
+
+# crunch_watch() waits for the sources to change and rebuilds only the stages they feed 
+# into, incrementally. Takes in the server started by --serve, if any, so that it can be 
+# shut down if the configuration changes and crunch has to start over.
+def crunch_watch(server):
+  args.incremental = True
+  
+  if args.verbose: 
+    print 'Watching for changes' + (not inotify_available and ' by polling' or '') + '.'
+  
+  for paths in watch_changes():
+    if args.verbose: 
+      print 'Changed: ' + ', '.join(sorted(os.path.relpath(path, base_folder) 
+                                           for path in paths))
+    
+    # Everything depends on the configuration, so start over with a full build.
+    if conf_file in paths:
+      if args.verbose: print 'Configuration changed, restarting.'
+      if server: server.server_close()
+      argv = [arg for arg in sys.argv[1:] if arg != '--all'] + ['--all']
+      os.execv(sys.executable, [sys.executable, base_folder + '/' + 
+                                os.path.basename(sys.argv[0])] + argv)
+    
+    def changed(folder):
+      return [path for path in paths if path.startswith(folder + '/')]
+    
+    output_counts['written'] = output_counts['skipped'] = 0
+    
+    # Give anything that failed last time another go, the source may have been fixed (or 
+    # only half copied when it was tried) and the shortener may be back.
+    derivative_failures.clear()
+    short_failures.clear()
+    
+    # A broken source shouldn't stop the watch, just report it and wait for the fix.
+    try:
+      ensure_build_folder()
       
-      # Included the minified js file, but don't process it.
-      if file.endswith('.min.js'):
-        js_min.append(open(scripts_folder + '/' + file).read())
-        
-    # Copy excluded files straight over with no changes.
-    if file.startswith('_'):
-      shutil.copy2(scripts_folder + '/' + file, build_folder + '/' + \
-        conf['scripts_folder'] + '/' + file.lstrip('_'))
+      # Every page links to the bundles by name, so new bundles mean building them all. 
+      # They are brought up to date first so nothing built below links the old ones.
+      relink = (changed(css_folder) or changed(scripts_folder)) and crunch_extras()
+      
+      if changed(posts_folder):
+        forget_posts()
+        get_index()
+        crunch_posts()
+        crunch_indexes()
+        crunch_home()
+        crunch_feed()
+      
+      if changed(pages_folder):
+        crunch_pages()
+      
+      names = set(os.path.relpath(path, galleries_folder).split('/')[0] 
+                  for path in changed(galleries_folder))
+      for name in sorted(names):
+        if os.path.isdir(galleries_folder + '/' + name):
+          crunch_derivatives(gallery_derivatives(name))
+          crunch_gallery(name)
+      
+      if relink:
+        crunch_errors()
+        crunch_pages()
+        crunch_posts()
+        crunch_indexes()
+        crunch_home()
+        crunch_gallery_all()
+        prune_bundles()
+      
+      if args.gzip:
+        crunch_gzip()
+    except (Exception, SystemExit):
+      traceback.print_exc()
     
-  # Write out our new minified JS file.
-  f = open(build_folder + '/' + conf['scripts_folder'] + '/app.js', 'w')
-  f.writelines(''.join(js_min))
-  f.close
-  os.chmod(build_folder + '/' + conf['scripts_folder'] + '/app.js', 0644)
-
+    if args.verbose:
+      print 'Wrote ' + str(output_counts['written']) + ' files, skipped ' + \
+        str(output_counts['skipped']) + ' unchanged.'
     
-  
-  
-  
+    if args.cache:
+      prune_cache()
+    save_manifest()
+    save_shorts()
+    save_index()
+
 ##########################################################################################
 ### Party Time.
 ##########################################################################################
 def main():
+  # Time everything if we're profiling.
+  if args.profile:
+    start_profile()
+  
   # Setup a new blog structure.
   if args.setup:
     sys.stderr.write('This build case not implemented yet.\nPlease build with --clean.\n')
@@ -1368,14 +2907,34 @@ def main():
   # Clean out the build folder.
   if args.clean:
     crunch_clean()
+
+  # Clear out the render cache.
+  if args.clear_cache:
+    crunch_clear_cache()
+  
+  # Import a whole mailbox of posts.
+  if args.import_mbox or args.import_maildir:
+    for path in filter(None, [args.import_mbox, args.import_maildir]):
+      if not os.path.exists(path):
+        print 'ERROR: Mailbox ' + path + ' does not exist.'
+        sys.exit(1)
+    ensure_build_folder()
+    
+    if args.import_mbox:
+      crunch_import(mailbox.mbox(args.import_mbox, create=False))
+    if args.import_maildir:
+      crunch_import(mailbox.Maildir(args.import_maildir, factory=None, create=False))
   
   # Process an email message that is fed in through STDIN.
-  if args.email:
+  elif args.email:
     # Ensure that we have a build folder to use.
     ensure_build_folder()
   
-    # Crunch the email and grab the new filename.
-    filename = crunch_email(email.message_from_string(sys.stdin.read()))
+    # Crunch the email and grab the new filename. The message is read a line at a time 
+    # through a buffer of our own, as stdin may be unbuffered (python -u).
+    stdin = os.fdopen(os.dup(sys.stdin.fileno()), 'rb', 65536)
+    filename = crunch_email(*read_email(stdin))
+    stdin.close()
   
     # Crunch the new post file and pass back the post object.
     post = crunch_single(open(filename).read())
@@ -1385,11 +2944,22 @@ def main():
     
     
   else:
-    # Just process a single post file.
+    # Just process a single post file, read from STDIN if it's -. The build folder is only
+    # set up if there isn't one yet, so that previewing an edit is quick.
     if args.single:
-      #ensure_build_folder()
-      #crunch_single()
-      sys.stderr.write('This build case not implemented yet.\n')
+      if not os.path.exists(build_folder):
+        ensure_build_folder()
+      
+      if args.single == '-':
+        string = sys.stdin.read()
+      elif os.path.exists(args.single):
+        string = open(args.single).read()
+      else:
+        print 'ERROR: Post ' + args.single + ' does not exist.'
+        sys.exit(1)
+      
+      # Crunch the post, and with --dependencies the pages that include it.
+      crunch_single(string)
     else:  
   
       # Re-process everything.
@@ -1398,6 +2968,12 @@ def main():
         # Make sure we have a build folder to use.
         ensure_build_folder()
         
+        # Bring the post index up to date, fetching any missing short urls in one go.
+        get_index()
+        
+        # Rebuild the extras first, so every page links to the new bundles.
+        crunch_extras()
+        
         # Rebuild the error pages
         crunch_errors()
   
@@ -1416,11 +2992,11 @@ def main():
         # Rebuild the feed.
         crunch_feed()
         
-        # Rebuild the extras.
-        crunch_extras()
-        
         # Build the galleries.
         crunch_gallery_all()
+        
+        # Every page links to the new bundles now, so the old ones can go.
+        prune_bundles()
       
       # We're going to do a partial rebuild.
       elif args.posts or args.home or args.indexes or args.feed or args.galleries or \
@@ -1430,38 +3006,68 @@ def main():
         
         if args.verbose: print 'Selectively building.'
         
+        # Bring the post index up to date, fetching any missing short urls in one go, if 
+        # we're building posts.
+        if args.posts or args.home or args.indexes or args.feed:
+          get_index()
+        
+        # Build the extras first if the --extras flag is set. Every page links to the 
+        # bundles by name, so new bundles mean building them all.
+        relink = args.extras and crunch_extras()
+        if relink and args.verbose: print 'The bundles changed, building every page.'
+        
         # Build error pages if the --error flag is set
-        if args.error:
+        if args.error or relink:
           crunch_errors()
           
         # Build static pages if the --pages flag is set
-        if args.pages:
+        if args.pages or relink:
           crunch_pages()
         
         # Build posts if the --posts flag is set.    
-        if args.posts:
+        if args.posts or relink:
           crunch_posts()    
         
         # Build home if the --home flag is set.
-        if args.home:
+        if args.home or relink:
           crunch_home()
   
         # Build indexes if the --indexes flag is set.
-        if args.indexes:
+        if args.indexes or relink:
           crunch_indexes()
           
         # Build the feed if the --feed flag is set.
         if args.feed:
           crunch_feed()
           
-        # Build the extras if the --extras flag is set.
-        if args.extras:
-          crunch_extras()
-          
         # Build the galleries if the --galleries flag is set.
-        if args.galleries:
+        if args.galleries or relink:
           crunch_gallery_all()
+        
+        # Every page links to the new bundles now, so the old ones can go.
+        if relink:
+          prune_bundles()
+  
+  # Compress whatever changed.
+  if args.gzip and os.path.exists(build_folder):
+    crunch_gzip()
+  
+  if args.verbose and (output_counts['written'] or output_counts['skipped']):
+    print 'Wrote ' + str(output_counts['written']) + ' files, skipped ' + \
+      str(output_counts['skipped']) + ' unchanged.'
+  
+  # Keep the render cache from growing without bound.
+  if args.cache:
+    prune_cache()
+
+  # Remember what was built from what for the next --incremental build.
+  save_manifest()
+  save_shorts()
+  save_index()
   
+  if args.profile:
+    report_profile()
+
   # Start up a uber-simple webserver to test the build on localhost. 
   if args.serve:
   
@@ -1478,39 +3084,143 @@ def main():
   
     if args.verbose: print 'Starting server.'
   
-    # Create a simple handler for HTTP GET requests.
+    # Create a handler for HTTP GET and HEAD requests. It speaks HTTP/1.1 so connections 
+    # are kept alive between requests, and answers conditional requests with a 304 when 
+    # the file hasn't changed. Idle connections are dropped after 30 seconds.
     class myHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      timeout = 30
+      
       def do_GET(self):
+        self.redirect_htm()
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+      
+      def do_HEAD(self):
+        self.redirect_htm()
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.do_HEAD(self)
+      
+      # For permalink compatibility, create a redirect so that '.htm' 
+      # isn't necessary for post pages or the later pages of a year or month index. 
+      # Enable with server_redirect_htm in the configuration file.
+      def redirect_htm(self):
         if args.verbose: print self.path
-  
-        # For permalink compatibility, create a redirect so that '.htm' 
-        # isn't necessary for post pages. Enable with server_redirect_htm in 
-        # the configuration file.
-        if conf['server_redirect_htm']:
-          if re.match('/\d\d\d\d\/\d\d\/\w', self.path):
+        
+        if conf['server_redirect_htm'] and not self.path.endswith('.htm'):
+          if re.match('/\d\d\d\d\/(\d\d\/\w|(\d\d\/)?page\/\d+$)', self.path):
             self.path = self.path + '.htm'
             if args.verbose: print 'redirecting to ' + self.path
-              
-        return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+      
+      # Sends the headers for a request and returns the file to send as the body, or 
+      # None if there's no body to send.
+      def send_head(self):
+        path = self.translate_path(self.path)
+        
+        if os.path.isdir(path):
+          # Folders are redirected to have a trailing slash, with an empty body so the 
+          # connection can be reused.
+          if not self.path.split('?', 1)[0].endswith('/'):
+            self.send_response(301)
+            self.send_header('Location', self.path.split('?', 1)[0] + '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+          
+          for index in 'index.html', 'index.htm':
+            if os.path.exists(os.path.join(path, index)):
+              path = os.path.join(path, index)
+              break
+          else:
+            # Directory listings don't know their length, so close the connection 
+            # after them.
+            self.close_connection = 1
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+        
+        # Send the gzipped copy made by --gzip instead if the client can take it and it's
+        # up to date.
+        ctype = self.guess_type(path)
+        encoded = gzip_current(path)
+        accepted = [encoding.split(';')[0].strip() for encoding in 
+                    (self.headers.getheader('Accept-Encoding') or '').split(',') 
+                    if not re.search(';\s*q=0(\.0*)?\s*$', encoding)]
+        gzipped = encoded and 'gzip' in accepted
+        if gzipped: path = path + '.gz'
+        
+        try:
+          f = open(path, 'rb')
+        except IOError:
+          self.send_error(404, 'File not found')
+          return None
+        
+        st = os.fstat(f.fileno())
+        etag = '"%x-%x%s"' % (int(st.st_mtime * 1000000), st.st_size, 
+                              gzipped and '-gz' or '')
+        
+        # Answer with a 304 if the client already has this version of the file.
+        modified = True
+        if self.headers.getheader('If-None-Match'):
+          tags = [tag.strip() for tag in self.headers.getheader('If-None-Match').split(',')]
+          modified = not (etag in tags or '*' in tags)
+        elif self.headers.getheader('If-Modified-Since'):
+          since = parsedate_tz(self.headers.getheader('If-Modified-Since'))
+          modified = since is None or int(st.st_mtime) > mktime_tz(since)
+        
+        self.send_response(modified and 200 or 304)
+        if modified:
+          self.send_header('Content-Type', ctype)
+          self.send_header('Content-Length', str(st.st_size))
+        if gzipped: self.send_header('Content-Encoding', 'gzip')
+        if encoded: self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Last-Modified', self.date_time_string(st.st_mtime))
+        self.send_header('ETag', etag)
+        # The bundles never change once written, so they can be kept for good.
+        if re.search('/app\.[0-9a-f]{6}\.(css|js)(\.gz)?$', path):
+          self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        else:
+          self.send_header('Cache-Control', 'public, max-age=' + 
+                           str(conf.get('server_max_age', 0)))
+        self.end_headers()
+        
+        if modified: return f
+        f.close()
+        return None
+    
+    # Serve each connection from its own thread so that one slow client doesn't hold up
+    # the rest.
+    class myServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+      daemon_threads = True
     
-    # Use the handler class and setup a SocketServer instance.
+    # Use the handler class and setup a server instance. The address is reused so that a
+    # --watch that restarts itself can get the port straight back.
     handler = myHandler
+    myServer.allow_reuse_address = True
     
     server = False
     
     while server == False:
       try:
-        server = SocketServer.TCPServer(("", conf['server_port']), handler)
+        server = myServer(("", conf['server_port']), handler)
       except:
         print "Port occupied... Retrying."
         time.sleep(5)
          
-    # Change to the build folder. 
+    # Change to the build folder. Work out the template signature first, as the source of 
+    # the templates can't be found from there and --watch will need it later.
+    template_signature()
     os.chdir(build_folder)
   
-    # Start up the server.
+    # Start up the server. With --watch it runs in the background while we wait for 
+    # changes.
     if args.verbose: print 'Server going live on port', conf['server_port']
-    server.serve_forever()
+    if args.watch:
+      thread = threading.Thread(target=server.serve_forever)
+      thread.daemon = True
+      thread.start()
+    else:
+      server.serve_forever()
+  
+  # Keep rebuilding as the sources change.
+  if args.watch:
+    crunch_watch(args.serve and server or None)
 
 if __name__ == "__main__":
   main()